@@ -1,140 +1,1645 @@
-import ccxt
+import argparse
+import asyncio
+import atexit
+import bisect
+import cProfile
+import functools
+import json
+import queue
+import subprocess
+import random
+import sqlite3
 import numpy as np
-import talib
-import pandas as pd
 import time
-import configparser
+import uuid
+import hashlib
+import importlib.util
+import inspect
+import heapq
+import itertools
 import logging
-import telegram
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
-from binance.client import Client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
 from configparser import ConfigParser
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, HTTPError
 
-# Загрузка конфигурации
-config = configparser.ConfigParser()
-config.read('config.ini')
+def lazy_import(name):
+    # Модуль загружается при первом обращении к атрибуту: импорт бота не тянет pandas, TA-Lib, ccxt и т.д.
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+ccxt = lazy_import('ccxt')
+talib = lazy_import('talib')
+pd = lazy_import('pandas')
+telegram = lazy_import('telegram')
+websocket = lazy_import('websocket')
+binance = lazy_import('binance')
+
+class LazyClient:
+    # Клиент создаётся при первом обращении: импорт модуля не ходит в сеть и не требует ключей API
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_client', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _resolve(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    object.__setattr__(self, '_client', self._factory())
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+# Значение margin_mode из конфига -> marginType Binance
+MARGIN_TYPES = {'isolated': 'ISOLATED', 'cross': 'CROSSED', 'crossed': 'CROSSED'}
+
+def _check_timeframe(timeframe):
+    if len(timeframe) < 2 or not timeframe[:-1].isdigit() or timeframe[-1] not in 'smhdwM':
+        raise ValueError(f"invalid timeframe {timeframe!r}")
+    return timeframe
 
-api_key = config['Binance']['api_key']
-api_secret = config['Binance']['api_secret']
-telegram_token = config['telegram']['token']
-telegram_chat_id = config['telegram']['chat_id']
+def read_config(file_path):
+    # Единственная проверка config.ini: все секции читаются и проверяются здесь, ошибка - сообщение в лог
+    # и выход, а не трейсбек при импорте. Ключи API нужны только для live-режима, их наличие
+    # проверяется при создании клиента, поэтому модуль импортируется и без них.
+    config = ConfigParser()
+    try:
+        if not config.read(file_path):
+            raise FileNotFoundError(f"{file_path} not found")
+        api_key = config.get('Binance', 'api_key', fallback='')
+        profiles = [section for section in config.sections() if section.startswith('Account:')]
+        has_keys = bool(api_key) or any(config.get(section, 'api_key', fallback='') for section in profiles)
+        # Без ключей API режим должен быть задан явно: иначе ошибка в конфиге тихо превращается в paper
+        mode = config.get('Bot', 'mode', fallback='live' if has_keys else '')
+        if not mode:
+            raise ValueError("no API keys configured; set [Bot] mode = paper to trade on simulated orders")
+        if mode not in ('live', 'paper'):
+            raise ValueError(f"unknown mode {mode!r}, expected live or paper")
+        # В paper-режиме без секции [Binance] используются консервативные значения по умолчанию.
+        # С профилями [Account:*] секция [Binance] - только значения по умолчанию для профилей,
+        # обязательность параметров риска проверяется для каждого профиля в load_accounts
+        required = mode == 'live' and not profiles
+        settings = {
+            'mode': mode,
+            'api_key': api_key,
+            'api_secret': config.get('Binance', 'api_secret', fallback=''),
+            'margin_mode': config.get('Binance', 'margin_mode') if required else config.get('Binance', 'margin_mode', fallback='isolated'),
+            'position_size_percent': config.getfloat('Binance', 'position_size_percent') if required else config.getfloat('Binance', 'position_size_percent', fallback=1),
+            'leverage': config.getint('Binance', 'leverage') if required else config.getint('Binance', 'leverage', fallback=1),
+            'take_profit_percent': config.getfloat('Binance', 'take_profit_percent') if required else config.getfloat('Binance', 'take_profit_percent', fallback=2),
+            'stop_loss_percent': config.getfloat('Binance', 'stop_loss_percent') if required else config.getfloat('Binance', 'stop_loss_percent', fallback=1),
+            'telegram_token': config.get('telegram', 'token', fallback=''),
+            'telegram_chat_id': config.get('telegram', 'chat_id', fallback=''),
+            'telegram_queue_size': config.getint('telegram', 'queue_size', fallback=100),
+            'telegram_batch_window': config.getfloat('telegram', 'batch_window', fallback=1.0),
+            'paper_balance': config.getfloat('Bot', 'paper_balance', fallback=1000),
+            'paper_position_mode': config.get('Bot', 'paper_position_mode', fallback='hedge'),
+            'scan_concurrency': config.getint('Scanner', 'concurrency', fallback=16),
+            'request_weight_limit': config.getint('Scanner', 'weight_limit', fallback=2400),
+            'order_rate_limit': config.getint('Scanner', 'order_limit', fallback=1200),
+            'candle_history': config.getint('Scanner', 'candle_history', fallback=500),
+            'base_timeframe': _check_timeframe(config.get('Timeframes', 'base', fallback='15m')),
+            'stream_enabled': config.getboolean('Stream', 'enabled', fallback=False),
+            'stream_record_path': config.get('Stream', 'record_path', fallback=''),
+            'indicator_engine': config.get('Indicators', 'engine', fallback='streaming'),
+            'exchange_info_ttl': config.getint('Cache', 'exchange_info_ttl', fallback=3600),
+            'exchange_info_path': config.get('Cache', 'exchange_info_path', fallback='exchange_info.json'),
+            'account_snapshot_max_age': config.getint('Account', 'snapshot_max_age', fallback=30),
+            'state_path': config.get('State', 'path', fallback='state.db'),
+            'paper_state_path': config.get('State', 'paper_path', fallback=''),
+            'batch_orders_enabled': config.getboolean('Orders', 'batch', fallback=True),
+            'screener_enabled': config.getboolean('Screener', 'enabled', fallback=True),
+            'screener_top_n': config.getint('Screener', 'top_n', fallback=0),
+            'screener_min_quote_volume': config.getfloat('Screener', 'min_quote_volume', fallback=0),
+            'screener_min_volatility': config.getfloat('Screener', 'min_volatility_percent', fallback=0),
+            'screener_max_volatility': config.getfloat('Screener', 'max_volatility_percent', fallback=0),
+            'screener_interval': config.getint('Screener', 'interval', fallback=900),
+            'scheduler_enabled': config.getboolean('Scheduler', 'enabled', fallback=True),
+            'scheduler_scan_delay': config.getfloat('Scheduler', 'scan_delay', fallback=2),
+            'scheduler_maintenance_interval': config.getfloat('Scheduler', 'maintenance_interval', fallback=10),
+            'scheduler_clock_sync_interval': config.getfloat('Scheduler', 'clock_sync_interval', fallback=600),
+            'scheduler_reconcile_interval': config.getfloat('Scheduler', 'reconcile_interval', fallback=900),
+            'metrics_port': config.getint('Metrics', 'port', fallback=9108),
+            'metrics_summary_interval': config.getint('Metrics', 'summary_interval', fallback=300),
+        }
+        settings['signal_timeframe'] = _check_timeframe(config.get('Timeframes', 'signal', fallback=settings['base_timeframe']))
+        settings['confirm_timeframes'] = [_check_timeframe(tf.strip()) for tf in config.get('Timeframes', 'confirm', fallback='').split(',') if tf.strip()]
+        settings['user_stream_enabled'] = config.getboolean('Stream', 'user_data', fallback=settings['stream_enabled'])
+        if settings['margin_mode'].lower() not in MARGIN_TYPES:
+            raise ValueError(f"margin_mode must be isolated or cross, got {settings['margin_mode']!r}")
+        if settings['leverage'] < 1 or settings['position_size_percent'] <= 0:
+            raise ValueError("leverage must be >= 1 and position_size_percent > 0")
+        if settings['take_profit_percent'] <= 0 or settings['stop_loss_percent'] <= 0:
+            raise ValueError("take_profit_percent and stop_loss_percent must be positive")
+        if settings['paper_position_mode'] not in ('hedge', 'one_way'):
+            raise ValueError(f"paper_position_mode must be hedge or one_way, got {settings['paper_position_mode']!r}")
+        if settings['indicator_engine'] not in ('streaming', 'talib'):
+            raise ValueError(f"indicator engine must be streaming or talib, got {settings['indicator_engine']!r}")
+        if settings['scan_concurrency'] < 1 or settings['candle_history'] < 1 or settings['telegram_queue_size'] < 1:
+            raise ValueError("concurrency, candle_history and telegram queue_size must be positive")
+        if not 0 <= settings['metrics_port'] <= 65535:
+            raise ValueError(f"metrics port must be 0-65535, got {settings['metrics_port']}")
+        return config, settings
+    except Exception as e:
+        logging.error(f"Error reading config file: {e}")
+        exit()
 
-margin_mode = config['Binance']['margin_mode']
-position_size_percent = float(config['Binance']['position_size_percent'])
-leverage = int(config['Binance']['leverage'])
-take_profit_percent = float(config['Binance']['take_profit_percent'])
-stop_loss_percent = float(config['Binance']['stop_loss_percent'])
+# Загрузка конфигурации
+config, settings = read_config(os.environ.get('BOT_CONFIG', 'config.ini'))
+
+# live - реальные ордера; paper - рыночные данные с биржи, ордера и позиции симулируются локально
+trading_mode = settings['mode']
+api_key = settings['api_key']
+api_secret = settings['api_secret']
+telegram_token = settings['telegram_token']
+telegram_chat_id = settings['telegram_chat_id']
+
+margin_mode = settings['margin_mode']
+position_size_percent = settings['position_size_percent']
+leverage = settings['leverage']
+take_profit_percent = settings['take_profit_percent']
+stop_loss_percent = settings['stop_loss_percent']
+
+# Настройки сканера рынка
+scan_concurrency = settings['scan_concurrency']
+request_weight_limit = settings['request_weight_limit']
+# Лимит ордеров на аккаунт в минуту (ORDERS 1M у Binance Futures)
+order_rate_limit = settings['order_rate_limit']
+candle_history = settings['candle_history']
+
+# Таймфреймы: свечи качаются только для base, signal и confirm собираются из них локально
+base_timeframe = settings['base_timeframe']
+signal_timeframe = settings['signal_timeframe']
+confirm_timeframes = settings['confirm_timeframes']
+
+# Настройки WebSocket-потоков
+stream_enabled = settings['stream_enabled']
+stream_record_path = settings['stream_record_path']
+
+# Движок индикаторов: streaming (инкрементальный) или talib (пересчёт всей серии)
+indicator_engine = settings['indicator_engine']
+
+# Кэш exchangeInfo
+exchange_info_ttl = settings['exchange_info_ttl']
+exchange_info_path = settings['exchange_info_path']
+
+# Снимок аккаунта: максимальный возраст без user-data потока
+account_snapshot_max_age = settings['account_snapshot_max_age']
+
+# Локальное хранилище состояния (SQLite); пустой путь - только в памяти
+state_path = settings['state_path']
+paper_state_path = settings['paper_state_path']
+user_stream_enabled = settings['user_stream_enabled']
+
+# Вход, TP и SL одним запросом batchOrders
+batch_orders_enabled = settings['batch_orders_enabled']
+
+# Предварительный отбор символов по 24h тикеру (top_n = 0 - без ограничения)
+screener_enabled = settings['screener_enabled']
+screener_top_n = settings['screener_top_n']
+screener_min_quote_volume = settings['screener_min_quote_volume']
+screener_min_volatility = settings['screener_min_volatility']
+screener_max_volatility = settings['screener_max_volatility']
+screener_interval = settings['screener_interval']
+
+# Планировщик: скан сигналов по закрытию свечи, обслуживание защитных ордеров чаще
+scheduler_enabled = settings['scheduler_enabled']
+scheduler_scan_delay = settings['scheduler_scan_delay']
+scheduler_maintenance_interval = settings['scheduler_maintenance_interval']
+scheduler_clock_sync_interval = settings['scheduler_clock_sync_interval']
+# Полная сверка стопов при живом user-data потоке - только страховочная, изменения приходят событиями
+scheduler_reconcile_interval = settings['scheduler_reconcile_interval']
+
+# Метрики: локальный HTTP endpoint (0 - выключен) и периодическая сводка в лог
+metrics_port = settings['metrics_port']
+metrics_summary_interval = settings['metrics_summary_interval']
 
 # Настройка Telegram бота
-telegram_bot = telegram.Bot(token=telegram_token)
+telegram_bot = LazyClient(lambda: telegram.Bot(token=telegram_token))
 
 # Настройка логирования
 logging.basicConfig(filename='bot.log', level=logging.INFO)
 
-# Создание экземпляра клиента Binance Futures (ccxt)
-exchange = ccxt.binance({
-    'apiKey': api_key,
-    'secret': api_secret,
-})
-exchange.options['defaultType'] = 'future'
-
-# Создание экземпляра клиента Binance (binance)
-binance_client = Client(api_key=api_key, api_secret=api_secret)
+def create_exchange():
+    # Создание экземпляра клиента Binance Futures (ccxt)
+    # Встроенный троттлинг ccxt сериализует запросы, поэтому лимиты считаем сами (WeightBudget)
+    live = trading_mode == 'live'
+    exchange = ccxt.binance({
+        'apiKey': api_key if live else None,
+        'secret': api_secret if live else None,
+        'enableRateLimit': False,
+    })
+    exchange.options['defaultType'] = 'future'
+    transport.mount(exchange.session)
+    instrument_ccxt(exchange)
+    return exchange
+
+def create_binance_client(key=None, secret=None, pool_size=None):
+    # Создание экземпляра клиента Binance (binance)
+    if trading_mode == 'live' and (not key or not secret):
+        logging.error("Binance api_key and api_secret are required in live mode")
+        exit()
+    client = None
+    if key and secret:
+        client = binance.Client(api_key=key, api_secret=secret)
+        transport.mount(client.session, pool_size or scan_concurrency)
+        instrument_binance(client)
+    if trading_mode == 'paper':
+        # Ордера не уходят на биржу; подписанный клиент (если есть ключи) только читает режим позиций
+        return PaperClient(market_client, settings['paper_balance'], client, settings['paper_position_mode'] == 'hedge')
+    return client
+
+def create_market_client():
+    # Неподписанный клиент общего конвейера (exchangeInfo, 24h тикеры, время биржи): ключи не нужны,
+    # поэтому скан не зависит от аккаунта [Binance]
+    client = binance.Client()
+    transport.mount(client.session)
+    instrument_binance(client)
+    return client
+
+exchange = LazyClient(create_exchange)
+market_client = LazyClient(create_market_client)
+binance_client = LazyClient(lambda: create_binance_client(api_key, api_secret))
 open_orders = {}
+profiling = False
+
+# Пул для параллельной отправки защитных ордеров
+order_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='orders')
+
+# Правила стратегии, общие для живой торговли и бэктеста
+MAX_POSITIONS_PER_SIDE = 5
+ORDER_DEDUP_SECONDS = 43200  # 12 hours
+BREAKEVEN_ROI = 15
+
+# Веса запросов Binance Futures по пути после /fapi/vN/ (лимит IP считается за минуту).
+# Для путей из SYMBOL_WEIGHTS запрос с symbol стоит дешевле, чем по всем символам.
+ENDPOINT_WEIGHTS = {
+    'exchangeInfo': 1,
+    'ticker/24hr': 40,
+    'ticker/price': 2,
+    'account': 5,
+    'balance': 5,
+    'positionRisk': 5,
+    'openOrders': 40,
+    'positionSide/dual': 30,
+    'leverage': 1,
+    'marginType': 1,
+    'order': 1,
+    'batchOrders': 5,
+    'allOpenOrders': 1,
+    'listenKey': 1,
+    'time': 1,
+}
+SYMBOL_WEIGHTS = {
+    'ticker/24hr': 1,
+    'ticker/price': 1,
+    'openOrders': 1,
+}
+
+def klines_weight(limit=None):
+    limit = 500 if limit is None else limit
+    if limit < 100:
+        return 1
+    if limit < 500:
+        return 2
+    if limit <= 1000:
+        return 5
+    return 10
+
+def request_weight(path, params=None):
+    # Вес запроса к /fapi по пути и параметрам; прочие API (спот, dapi) считаются в своих лимитах
+    if not path.startswith('/fapi/'):
+        return 0
+    params = params or {}
+    endpoint = path.split('/', 3)[-1]
+    if endpoint == 'klines':
+        return klines_weight(int(params['limit']) if 'limit' in params else None)
+    if params.get('symbol') and endpoint in SYMBOL_WEIGHTS:
+        return SYMBOL_WEIGHTS[endpoint]
+    return ENDPOINT_WEIGHTS.get(endpoint, 1)
+
+class WeightBudget:
+    # Binance считает вес IP в окне календарной минуты, поэтому бюджет обнуляется на границе минуты.
+    # Заголовок X-MBX-USED-WEIGHT-1M (sync) учитывает и запросы, которые прошли мимо этого счётчика.
+    def __init__(self, limit, window=60):
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.period = int(time.time() // window)
+        self.used = 0
+
+    def _roll(self):
+        period = int(time.time() // self.window)
+        if period != self.period:
+            self.period = period
+            self.used = 0
+
+    def acquire(self, weight):
+        while True:
+            with self.lock:
+                self._roll()
+                if self.used + weight <= self.limit or self.used == 0:
+                    self.used += weight
+                    return
+                wait = (self.period + 1) * self.window - time.time()
+            time.sleep(max(wait, 0.01))
+
+    def sync(self, used):
+        # Вес ещё не отвеченных запросов сервер не знает, поэтому локальную оценку только повышаем
+        with self.lock:
+            self._roll()
+            self.used = max(self.used, used)
+
+request_budget = WeightBudget(request_weight_limit)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+class Metrics:
+    # Гистограммы, счётчики и gauge в памяти процесса; отдаются в формате Prometheus
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            histogram['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            histogram['max'] = max(histogram['max'], value)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+    def render(self):
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE bot_{name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(name, 'counter')
+                lines.append(f"bot_{name}{self._labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                declare(name, 'gauge')
+                lines.append(f"bot_{name}{self._labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                declare(name, 'histogram')
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f"bot_{name}_bucket{self._labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"bot_{name}_sum{self._labels(labels)} {histogram['sum']}")
+                lines.append(f"bot_{name}_count{self._labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                average = histogram['sum'] / histogram['count'] * 1000
+                lines.append(f"{name}{self._labels(labels)}: count={histogram['count']} avg={average:.1f}ms max={histogram['max'] * 1000:.1f}ms")
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{self._labels(labels)}: {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{name}{self._labels(labels)}: {value}")
+        return '\n'.join(lines)
+
+metrics = Metrics()
+
+def timed(span):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe('span_seconds', time.perf_counter() - started, span=span)
+        return wrapper
+    return decorator
+
+def _record_used_weight(client_name, headers):
+    used = headers.get('X-MBX-USED-WEIGHT-1M') if headers else None
+    if used is not None:
+        metrics.set_gauge('used_weight_1m', int(used), client=client_name)
+
+def instrument_ccxt(exchange):
+    fetch = exchange.fetch
+
+    def timed_fetch(url, method='GET', headers=None, body=None):
+        endpoint = urlparse(url).path
+        started = time.perf_counter()
+        try:
+            return fetch(url, method, headers, body)
+        except Exception:
+            metrics.inc('http_errors_total', client='ccxt', endpoint=endpoint)
+            raise
+        finally:
+            metrics.observe('http_request_seconds', time.perf_counter() - started, client='ccxt', endpoint=endpoint)
+            metrics.inc('http_requests_total', client='ccxt', endpoint=endpoint)
+            _record_used_weight('ccxt', exchange.last_response_headers)
+
+    exchange.fetch = timed_fetch
+
+def instrument_binance(client):
+    request = client._request
+
+    def timed_request(method, uri, signed, force_params=False, **kwargs):
+        endpoint = urlparse(uri).path
+        started = time.perf_counter()
+        try:
+            return request(method, uri, signed, force_params, **kwargs)
+        except Exception:
+            metrics.inc('http_errors_total', client='binance', endpoint=endpoint)
+            raise
+        finally:
+            metrics.observe('http_request_seconds', time.perf_counter() - started, client='binance', endpoint=endpoint)
+            metrics.inc('http_requests_total', client='binance', endpoint=endpoint)
+            if client.response is not None:
+                _record_used_weight('binance', client.response.headers)
+
+    client._request = timed_request
+
+def backoff_delay(attempt, base=0.5, cap=30):
+    # Экспоненциальная задержка с полным джиттером: повторы разных потоков не совпадают по времени
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def is_retryable(error):
+    return isinstance(error, (ConnectionError, HTTPError)) or getattr(error, 'status_code', None) in (418, 429)
+
+class CircuitBreaker:
+    # После 429 или 418 (бан IP) запросы не уходят до истечения Retry-After: продолжение
+    # запросов во время ограничения только продлевает бан
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open_until = 0
+
+    def trip(self, status, retry_after):
+        with self.lock:
+            until = time.time() + retry_after
+            if until <= self.open_until:
+                return
+            self.open_until = until
+        metrics.inc('circuit_breaker_trips_total', status=str(status))
+        logging.error(f"HTTP {status} from Binance, pausing requests for {retry_after}s")
+        if status == 418:
+            send_telegram_message(f"IP banned by Binance (HTTP 418), requests paused for {retry_after}s")
+
+    def wait(self):
+        delay = self.open_until - time.time()
+        if delay > 0:
+            metrics.inc('circuit_breaker_waits_total')
+            time.sleep(delay)
+
+class Transport:
+    # Общий HTTP-слой ccxt и python-binance: пул keep-alive соединений, общий для всех аккаунтов
+    # бюджет веса IP (резерв по пути до отправки, сверка по заголовкам после),
+    # автомат-выключатель на 418/429 и повторы с джиттером. Подписанные запросы не повторяются
+    # здесь: у них истекает timestamp, их повторяет вызывающий код с новой подписью.
+    def __init__(self, budget, breaker, max_retries=4):
+        self.budget = budget
+        self.breaker = breaker
+        self.max_retries = max_retries
+
+    def mount(self, session, pool_size=scan_concurrency):
+        session.mount('https://', TransportAdapter(self, pool_connections=4, pool_maxsize=pool_size))
+
+    def send(self, send, request, **kwargs):
+        retryable = request.method == 'GET' and 'signature=' not in request.url
+        url = urlparse(request.url)
+        params = dict(parse_qsl(url.query))
+        # Подписанные POST/PUT/DELETE python-binance передаёт параметры в теле формы
+        if isinstance(request.body, (str, bytes)):
+            body = request.body.decode() if isinstance(request.body, bytes) else request.body
+            params.update(parse_qsl(body))
+        weight = request_weight(url.path, params)
+        for attempt in range(self.max_retries + 1):
+            self.breaker.wait()
+            # Каждая попытка, в том числе повтор, расходует вес на сервере
+            if weight:
+                self.budget.acquire(weight)
+            try:
+                response = send(request, **kwargs)
+            except ConnectionError:
+                if not retryable or attempt == self.max_retries:
+                    raise
+                metrics.inc('retries_total', operation='http')
+                time.sleep(backoff_delay(attempt))
+                continue
 
-def read_config(file_path):
-    config = ConfigParser()
+            used = response.headers.get('X-MBX-USED-WEIGHT-1M')
+            if used is not None and weight:
+                self.budget.sync(int(used))
+            if response.status_code in (418, 429):
+                default = 120 if response.status_code == 418 else backoff_delay(attempt, base=1, cap=60)
+                self.breaker.trip(response.status_code, float(response.headers.get('Retry-After', default)))
+            elif response.status_code < 500:
+                return response
+            if not retryable or attempt == self.max_retries:
+                return response
+            metrics.inc('retries_total', operation='http')
+            if response.status_code >= 500:
+                time.sleep(backoff_delay(attempt))
+        return response
+
+class TransportAdapter(HTTPAdapter):
+    def __init__(self, transport, **kwargs):
+        self.transport = transport
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        return self.transport.send(super().send, request, **kwargs)
+
+circuit_breaker = CircuitBreaker()
+transport = Transport(request_budget, circuit_breaker)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    # Занятый порт не должен останавливать торговлю: бот работает дальше без эндпоинта
     try:
-        config.read(file_path)
-        settings = {
-            'api_key': config.get('Binance', 'api_key'),
-            'api_secret': config.get('Binance', 'api_secret'),
-            'margin_mode': config.get('Binance', 'margin_mode'),
-            'position_size_percent': float(config.get('Binance', 'position_size_percent')),
-            'leverage': int(config.get('Binance', 'leverage')),
-            'take_profit_percent': float(config.get('Binance', 'take_profit_percent')),
-            'stop_loss_percent': float(config.get('Binance', 'stop_loss_percent')),
-        }
-        return settings
-    except Exception as e:
-        logging.error(f"Error reading config file: {e}")
-        exit()
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        logging.error(f"Metrics endpoint disabled, cannot bind 127.0.0.1:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f"Metrics endpoint listening on http://127.0.0.1:{server.server_port}/metrics")
+    return server
+
+def start_metrics_reporter(interval):
+    def report():
+        while True:
+            time.sleep(interval)
+            metrics.set_gauge('request_budget_used', request_budget.used)
+            logging.info("Metrics summary:\n" + metrics.summary())
+    threading.Thread(target=report, name='metrics-report', daemon=True).start()
+
+OHLCV_COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+TIMEFRAME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'M': 2592000, 'y': 31536000}
+
+def parse_timeframe(timeframe):
+    # Длина таймфрейма в секундах, как ccxt.Exchange.parse_timeframe, но без импорта ccxt
+    return int(timeframe[:-1]) * TIMEFRAME_UNITS[timeframe[-1]]
+
+class CandleBuffer:
+    # Кольцевой буфер двойной длины: последние capacity свечей всегда лежат непрерывно,
+    # поэтому срезы отдаются в TA-Lib без копирования
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros((len(OHLCV_COLUMNS), capacity * 2), dtype=np.float64)
+        self.head = 0
+        self.tail = 0
+        self.seeded = False
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def last_timestamp(self):
+        if self.tail == self.head:
+            return None
+        return int(self.data[0, self.tail - 1])
 
-def initialize_client(api_key, api_secret):
-    try:
-        return Client(api_key=api_key, api_secret=api_secret)
-    except Exception as e:
-        logging.error(f"Error initializing Binance client: {e}")
+    def extend(self, bars):
+        for bar in bars:
+            last = self.last_timestamp()
+            if last is not None and bar[0] < last:
+                continue
+            if last is not None and bar[0] == last:
+                # Незакрытая свеча обновляется на месте
+                self.data[:, self.tail - 1] = bar[:len(OHLCV_COLUMNS)]
+                continue
+            if self.tail == self.data.shape[1]:
+                keep = self.capacity - 1
+                self.data[:, :keep] = self.data[:, self.tail - keep:self.tail]
+                self.head, self.tail = 0, keep
+            self.data[:, self.tail] = bar[:len(OHLCV_COLUMNS)]
+            self.tail += 1
+            if self.tail - self.head > self.capacity:
+                self.head += 1
+
+    def columns(self, closed_before=None, timeframe_ms=None):
+        tail = self.tail
+        if closed_before is not None:
+            # Отбрасываем свечи, которые к моменту closed_before ещё не закрылись
+            tail = self.head + int(np.searchsorted(self.data[0, self.head:self.tail], closed_before - timeframe_ms, side='right'))
+        return {column: self.data[i, self.head:tail] for i, column in enumerate(OHLCV_COLUMNS)}
+
+class CandleStore:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def update(self, exchange, symbol, timeframe):
+        key = (symbol, timeframe)
+        with self.lock:
+            buffer = self.buffers.get(key)
+        # Буфер, собранный только из потока, без истории: засеиваем через REST
+        since = buffer.last_timestamp() if buffer is not None and buffer.seeded else None
+
+        if since is not None:
+            # Догружаем только незакрытую свечу и появившиеся после неё
+            timeframe_ms = parse_timeframe(timeframe) * 1000
+            missing = int((exchange.milliseconds() - since) // timeframe_ms) + 2
+            if missing > self.capacity:
+                since = None
+
+        if since is None:
+            bars = exchange.fetch_ohlcv(symbol, timeframe=timeframe, limit=self.capacity)
+            buffer = CandleBuffer(self.capacity)
+            buffer.extend(bars)
+            buffer.seeded = True
+            with self.lock:
+                self.buffers[key] = buffer
+        else:
+            bars = exchange.fetch_ohlcv(symbol, timeframe=timeframe, since=since, limit=missing)
+            buffer.extend(bars)
+
+        return buffer.columns()
+
+    def apply_kline(self, symbol, timeframe, bar):
+        key = (symbol, timeframe)
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = self.buffers[key] = CandleBuffer(self.capacity)
+        buffer.extend([bar])
+
+    def closed(self, symbol, timeframe, closed_before):
+        with self.lock:
+            buffer = self.buffers.get((symbol, timeframe))
+        if buffer is None:
+            return None
+        return buffer.columns(closed_before, parse_timeframe(timeframe) * 1000)
+
+candle_store = CandleStore(candle_history)
+
+# Старшие таймфреймы строятся из буфера base, поэтому его глубина ограничивает их историю
+for _timeframe in [signal_timeframe] + confirm_timeframes:
+    _ratio = parse_timeframe(_timeframe) / parse_timeframe(base_timeframe)
+    if _ratio < 1 or _ratio != int(_ratio) or parse_timeframe(_timeframe) > 86400:
+        logging.error(f"Timeframe {_timeframe} cannot be built from {base_timeframe} candles")
         exit()
+    if candle_history / _ratio < 30:
+        logging.warning(f"Only {int(candle_history / _ratio)} {_timeframe} candles fit in candle_history={candle_history}, indicators may not warm up")
+
+class StateStore:
+    # Состояние бота в SQLite (WAL): намерения ордеров, ордера, исполнения, время последнего входа
+    # по символу и кэш метаданных. Переживает перезапуск, поэтому старт не начинается с нуля.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS intents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            symbol TEXT NOT NULL,
+            position_side TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            order_id INTEGER,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS intents_symbol ON intents (symbol);
+        CREATE INDEX IF NOT EXISTS intents_status ON intents (status);
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id INTEGER PRIMARY KEY,
+            symbol TEXT NOT NULL,
+            type TEXT,
+            side TEXT,
+            position_side TEXT,
+            quantity TEXT,
+            stop_price TEXT,
+            status TEXT,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS orders_symbol ON orders (symbol);
+        CREATE TABLE IF NOT EXISTS fills (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            symbol TEXT NOT NULL,
+            order_id INTEGER NOT NULL,
+            side TEXT,
+            position_side TEXT,
+            price REAL,
+            quantity REAL,
+            realized_pnl REAL,
+            time REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS fills_symbol ON fills (symbol, time);
+        CREATE TABLE IF NOT EXISTS entries (
+            symbol TEXT PRIMARY KEY,
+            placed_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        if path:
+            # WAL: запись не блокирует чтение, а после падения БД остаётся согласованной
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self.lock, self.db:
+            cursor = self.db.execute(sql, params)
+            return cursor.fetchall() if cursor.description else cursor.lastrowid
+
+    def record_entry(self, symbol, placed_at=None):
+        self._execute('INSERT OR REPLACE INTO entries (symbol, placed_at) VALUES (?, ?)', (symbol, placed_at or time.time()))
+
+    def entry_times(self, max_age=None):
+        since = time.time() - max_age if max_age else 0
+        return {row['symbol']: row['placed_at'] for row in self._execute('SELECT symbol, placed_at FROM entries WHERE placed_at >= ?', (since,))}
+
+    def prune_entries(self, max_age):
+        self._execute('DELETE FROM entries WHERE placed_at < ?', (time.time() - max_age,))
+
+    def add_intent(self, symbol, position_side, params):
+        now = time.time()
+        return self._execute(
+            'INSERT INTO intents (symbol, position_side, params, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (symbol, position_side, json.dumps(params), 'pending', now, now),
+        )
+
+    def update_intent(self, intent_id, status, order_id=None):
+        self._execute('UPDATE intents SET status = ?, order_id = COALESCE(?, order_id), updated_at = ? WHERE id = ?', (status, order_id, time.time(), intent_id))
+
+    def pending_intents(self):
+        return [dict(row) for row in self._execute("SELECT * FROM intents WHERE status = 'pending'")]
+
+    def intents(self, symbol):
+        return [dict(row) for row in self._execute('SELECT * FROM intents WHERE symbol = ? ORDER BY id', (symbol,))]
+
+    def record_order(self, order, status=None):
+        self._execute(
+            'INSERT OR REPLACE INTO orders (order_id, symbol, type, side, position_side, quantity, stop_price, status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (order['orderId'], order['symbol'], order.get('type'), order.get('side'), order.get('positionSide'),
+             order.get('origQty'), order.get('stopPrice'), status or order.get('status'), time.time()),
+        )
+
+    def update_order_status(self, order_id, status):
+        self._execute('UPDATE orders SET status = ?, updated_at = ? WHERE order_id = ?', (status, time.time(), order_id))
+
+    def open_orders(self, symbol=None):
+        if symbol is None:
+            rows = self._execute("SELECT * FROM orders WHERE status IN ('NEW', 'PARTIALLY_FILLED')")
+        else:
+            rows = self._execute("SELECT * FROM orders WHERE symbol = ? AND status IN ('NEW', 'PARTIALLY_FILLED')", (symbol,))
+        return [dict(row) for row in rows]
+
+    def record_fill(self, symbol, order_id, side, position_side, price, quantity, realized_pnl, fill_time):
+        self._execute(
+            'INSERT INTO fills (symbol, order_id, side, position_side, price, quantity, realized_pnl, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (symbol, order_id, side, position_side, price, quantity, realized_pnl, fill_time),
+        )
+
+    def fills(self, symbol, since=0):
+        return [dict(row) for row in self._execute('SELECT * FROM fills WHERE symbol = ? AND time >= ? ORDER BY time', (symbol, since))]
+
+    def get_meta(self, key):
+        rows = self._execute('SELECT value, updated_at FROM metadata WHERE key = ?', (key,))
+        if not rows:
+            return None, 0
+        return json.loads(rows[0]['value']), rows[0]['updated_at']
+
+    def set_meta(self, key, value, updated_at=None):
+        self._execute('INSERT OR REPLACE INTO metadata (key, value, updated_at) VALUES (?, ?, ?)', (key, json.dumps(value), updated_at or time.time()))
+
+    def on_user_event(self, event):
+        # Слушатель UserDataStream: статусы ордеров и исполнения пишутся по мере прихода
+        if event.get('e') != 'ORDER_TRADE_UPDATE':
+            return
+        o = event['o']
+        self.record_order({
+            'symbol': o['s'],
+            'orderId': o['i'],
+            'type': o.get('ot', o['o']),
+            'side': o['S'],
+            'positionSide': o['ps'],
+            'origQty': o['q'],
+            'stopPrice': o['sp'],
+            'status': o['X'],
+        })
+        if o['x'] == 'TRADE':
+            self.record_fill(o['s'], o['i'], o['S'], o['ps'], float(o['L']), float(o['l']), float(o.get('rp', 0)), o['T'] / 1000)
+
+# Время последних входов загружается в open_orders при сверке на старте (reconcile_state)
+def open_state_store(live_path, paper_path=''):
+    # Путь выбирается при первом обращении: --paper переключает режим уже после импорта,
+    # и paper-прогон не должен писать в базу live-аккаунта
+    return StateStore(live_path if trading_mode == 'live' else paper_path)
+
+state_store = LazyClient(lambda: open_state_store(state_path, paper_state_path))
+
+# Параметры риска аккаунта по умолчанию из секции [Binance]
+default_settings = {
+    'margin_mode': margin_mode,
+    'position_size_percent': position_size_percent,
+    'leverage': leverage,
+    'take_profit_percent': take_profit_percent,
+    'stop_loss_percent': stop_loss_percent,
+    'sides': ('LONG', 'SHORT'),
+}
+
+class Account:
+    # Профиль аккаунта/стратегии: свой клиент, лимит числа ордеров, пул соединений, состояние и параметры риска.
+    # Вес IP общий для всех аккаунтов и учитывается в Transport.
+    # Свечи, индикаторы и сигналы общие для всех аккаунтов процесса.
+    def __init__(self, name, client, settings, store, orders=None, order_limit=order_rate_limit):
+        self.name = name
+        self.client = client
+        self.settings = settings
+        self.state_store = store
+        self.order_budget = WeightBudget(order_limit)
+        self.open_orders = orders if orders is not None else {}
+        # Ордера одного аккаунта выставляются последовательно, разных аккаунтов - параллельно
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(1, f"account-{name}")
+
+    def submit(self, symbol, signal, price, position_side):
+        if position_side not in self.settings['sides']:
+            return None
+        return self.executor.submit(self._process, symbol, signal, price, position_side)
+
+    def _process(self, symbol, signal, price, position_side):
+        with self.lock:
+            process_signal(symbol, signal, price, position_side, self)
+
+accounts = {}
+
+def get_account(client):
+    # Клиент без профиля (основной или мок в бенчмарке) торгует с настройками [Binance]
+    account = accounts.get(client)
+    if account is None:
+        account = accounts[client] = Account('default', client, default_settings, state_store, open_orders)
+    return account
+
+# Параметры риска, без которых live-профиль не запускается (значения по умолчанию берутся из [Binance])
+RISK_OPTIONS = ('margin_mode', 'position_size_percent', 'leverage', 'take_profit_percent', 'stop_loss_percent')
+
+def load_accounts(config):
+    profiles = [section for section in config.sections() if section.startswith('Account:')]
+    if not profiles:
+        return [get_account(binance_client)]
+
+    loaded = []
+    for section in profiles:
+        profile = config[section]
+        name = section.split(':', 1)[1].strip()
+        # Профили проверяются так же, как read_config: ошибка в значении - сообщение и выход, без трейсбека
+        try:
+            if not profile.getboolean('enabled', fallback=True):
+                continue
+            if trading_mode == 'live':
+                missing = [key for key in RISK_OPTIONS if not profile.get(key) and not config.get('Binance', key, fallback='')]
+                if missing:
+                    raise ValueError(f"{', '.join(missing)} must be set in [{section}] or [Binance] in live mode")
+            pool_size = profile.getint('pool_size', fallback=4)
+            order_limit = profile.getint('order_limit', fallback=order_rate_limit)
+            settings = {
+                'margin_mode': profile.get('margin_mode', fallback=margin_mode),
+                'position_size_percent': profile.getfloat('position_size_percent', fallback=position_size_percent),
+                'leverage': profile.getint('leverage', fallback=leverage),
+                'take_profit_percent': profile.getfloat('take_profit_percent', fallback=take_profit_percent),
+                'stop_loss_percent': profile.getfloat('stop_loss_percent', fallback=stop_loss_percent),
+                'sides': tuple(side.strip().upper() for side in profile.get('sides', fallback='LONG,SHORT').split(',')),
+            }
+            if settings['margin_mode'].lower() not in MARGIN_TYPES:
+                raise ValueError(f"margin_mode must be isolated or cross, got {settings['margin_mode']!r}")
+            if settings['leverage'] < 1 or settings['position_size_percent'] <= 0:
+                raise ValueError("leverage must be >= 1 and position_size_percent > 0")
+            if settings['take_profit_percent'] <= 0 or settings['stop_loss_percent'] <= 0:
+                raise ValueError("take_profit_percent and stop_loss_percent must be positive")
+            if not set(settings['sides']) <= {'LONG', 'SHORT'}:
+                raise ValueError(f"sides must be LONG and/or SHORT, got {profile.get('sides')!r}")
+        except ValueError as e:
+            logging.error(f"Account {name}: {e}")
+            exit()
+        client = LazyClient(functools.partial(create_binance_client, profile.get('api_key', ''), profile.get('api_secret', ''), pool_size))
+        store = LazyClient(functools.partial(open_state_store, profile.get('state_path', fallback=f"state_{name}.db")))
+        account = accounts[client] = Account(name, client, settings, store, order_limit=order_limit)
+        loaded.append(account)
+        logging.info(f"Loaded account profile {name}: {settings}")
+    return loaded
+
+trading_accounts = load_accounts(config)
+
+def dispatch_signal(symbol, signal, price, position_side):
+    # Один сигнал из общего конвейера раздаётся исполнителям всех аккаунтов
+    futures = [account.submit(symbol, signal, price, position_side) for account in trading_accounts]
+    return [future for future in futures if future is not None]
+
+class SymbolMetadata:
+    # Индекс exchangeInfo по символу: payload скачивается не чаще раза в ttl секунд
+    def __init__(self, ttl, path, store=None):
+        self.ttl = ttl
+        self.path = path
+        self.store = store
+        self.symbols = {}
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def _persistent_store(self):
+        # Хранилище в памяти (paper без [State] paper_path) не переживает рестарт:
+        # тогда тёплый старт обеспечивает JSON-файл [Cache] exchange_info_path
+        if self.store is not None and self.store.path:
+            return self.store
+        return None
+
+    @staticmethod
+    def parse(symbol):
+        filters = {f['filterType']: f for f in symbol.get('filters', [])}
+        return {
+            'status': symbol.get('status'),
+            'contract_type': symbol.get('contractType'),
+            'quote_asset': symbol.get('quoteAsset'),
+            'step_size': float(filters['LOT_SIZE']['stepSize']) if 'LOT_SIZE' in filters else None,
+            'tick_size': float(filters['PRICE_FILTER']['tickSize']) if 'PRICE_FILTER' in filters else None,
+            'min_notional': float(filters['MIN_NOTIONAL']['notional']) if 'MIN_NOTIONAL' in filters else None,
+        }
+
+    def load(self):
+        self.loaded = True
+        store = self._persistent_store()
+        if store is not None:
+            symbols, fetched_at = store.get_meta('exchange_info')
+            if symbols:
+                self.symbols, self.fetched_at = symbols, fetched_at
+            return
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            self.symbols = cached['symbols']
+            self.fetched_at = cached['fetched_at']
+        except Exception as e:
+            logging.error(f"Error loading cached exchange info: {e}")
+
+    def save(self):
+        store = self._persistent_store()
+        if store is not None:
+            store.set_meta('exchange_info', self.symbols, self.fetched_at)
+            return
+        if not self.path:
+            return
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'fetched_at': self.fetched_at, 'symbols': self.symbols}, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"Error saving exchange info cache: {e}")
+
+    def refresh(self, client):
+        info = client.futures_exchange_info()
+        self.symbols = {symbol['symbol']: self.parse(symbol) for symbol in info['symbols']}
+        self.fetched_at = time.time()
+        self.save()
+        logging.info(f"Exchange info refreshed: {len(self.symbols)} symbols")
+
+    def cached(self, symbol):
+        # Без обращения к бирже: для бэктеста и инструментов
+        with self.lock:
+            if not self.loaded:
+                self.load()
+        return self.symbols.get(symbol)
+
+    def get(self, client, symbol):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if time.time() - self.fetched_at > self.ttl:
+                try:
+                    self.refresh(client)
+                except Exception as e:
+                    if not self.symbols:
+                        raise
+                    logging.error(f"Error refreshing exchange info, using cached copy: {e}")
+        return self.symbols.get(symbol)
+
+symbol_metadata = SymbolMetadata(exchange_info_ttl, exchange_info_path, state_store if state_path else None)
+
+class AccountSnapshot:
+    # Баланс, позиции и открытые ордера аккаунта за один цикл: два REST-запроса
+    # вместо futures_account()/futures_get_open_orders() в каждой функции.
+    # При живом user-data потоке снимок обновляется событиями и REST не нужен.
+    def __init__(self, client, max_age):
+        self.client = client
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.balance = None
+        self.positions = {}
+        self.orders = {}
+        self.refreshed_at = 0
+        self.live = False
+
+    def refresh(self):
+        account_info = self.client.futures_account()
+        orders = self.client.futures_get_open_orders()
+        with self.lock:
+            self.balance = float(account_info['totalWalletBalance'])
+            self.positions = {}
+            for pos in account_info['positions']:
+                if float(pos['positionAmt']) != 0:
+                    self.positions[(pos['symbol'], pos['positionSide'])] = pos
+            self.orders = {}
+            for order in orders:
+                self.orders.setdefault(order['symbol'], {})[order['orderId']] = order
+            self.refreshed_at = time.time()
+
+    def ensure_fresh(self):
+        if not self.live and time.time() - self.refreshed_at > self.max_age:
+            self.refresh()
+
+    def invalidate(self):
+        if not self.live:
+            self.refreshed_at = 0
+
+    def get_balance(self):
+        self.ensure_fresh()
+        return self.balance
+
+    def open_positions(self, position_side=None):
+        self.ensure_fresh()
+        with self.lock:
+            return [pos for (symbol, side), pos in self.positions.items() if position_side is None or side == position_side]
+
+    def has_position(self, symbol):
+        self.ensure_fresh()
+        with self.lock:
+            return any(key[0] == symbol for key in self.positions)
+
+    def open_orders(self, symbol=None):
+        self.ensure_fresh()
+        with self.lock:
+            if symbol is not None:
+                return list(self.orders.get(symbol, {}).values())
+            return [order for orders in self.orders.values() for order in orders.values()]
+
+    def add_order(self, order):
+        with self.lock:
+            self.orders.setdefault(order['symbol'], {})[order['orderId']] = order
+
+    def remove_order(self, symbol, order_id):
+        with self.lock:
+            self.orders.get(symbol, {}).pop(order_id, None)
+
+    def apply_event(self, event):
+        with self.lock:
+            if event.get('e') == 'ACCOUNT_UPDATE':
+                for asset in event['a'].get('B', []):
+                    if asset['a'] == 'USDT':
+                        self.balance = float(asset['wb'])
+                for pos in event['a'].get('P', []):
+                    key = (pos['s'], pos['ps'])
+                    if float(pos['pa']) == 0:
+                        self.positions.pop(key, None)
+                    else:
+                        self.positions[key] = {
+                            'symbol': pos['s'],
+                            'positionSide': pos['ps'],
+                            'positionAmt': pos['pa'],
+                            'entryPrice': pos['ep'],
+                        }
+            elif event.get('e') == 'ORDER_TRADE_UPDATE':
+                o = event['o']
+                if o['X'] in ('NEW', 'PARTIALLY_FILLED'):
+                    self.add_order({
+                        'symbol': o['s'],
+                        'orderId': o['i'],
+                        'clientOrderId': o['c'],
+                        'type': o.get('ot', o['o']),
+                        'side': o['S'],
+                        'positionSide': o['ps'],
+                        'origQty': o['q'],
+                        'stopPrice': o['sp'],
+                        'status': o['X'],
+                    })
+                else:
+                    self.remove_order(o['s'], o['i'])
+
+account_snapshots = {}
+
+def get_account_snapshot(client):
+    snapshot = account_snapshots.get(client)
+    if snapshot is None:
+        snapshot = account_snapshots[client] = AccountSnapshot(client, account_snapshot_max_age)
+    return snapshot
+
+USER_STREAM_URL = 'wss://fstream.binance.com/ws/'
+
+class UserDataStream:
+    # ACCOUNT_UPDATE/ORDER_TRADE_UPDATE держат снимок аккаунта актуальным
+    def __init__(self, client, listeners=None):
+        self.client = client
+        self.snapshot = get_account_snapshot(client)
+        self.listeners = listeners or []
+        self.listen_key = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='user-stream', daemon=True).start()
+        threading.Thread(target=self._keepalive, name='user-stream-keepalive', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _keepalive(self):
+        while not self.stopped.wait(30 * 60):
+            try:
+                if self.listen_key:
+                    self.client.futures_stream_keepalive(listenKey=self.listen_key)
+            except Exception as e:
+                logging.error(f"Error keeping user data stream alive: {e}")
+
+    def _run(self):
+        delay = 1
+        while not self.stopped.is_set():
+            try:
+                self.listen_key = self.client.futures_stream_get_listen_key()
+                ws = websocket.WebSocketApp(
+                    USER_STREAM_URL + self.listen_key,
+                    on_open=lambda ws: self._on_open(),
+                    on_message=lambda ws, message: self.handle_message(message),
+                    on_error=lambda ws, error: logging.error(f"User data stream error: {error}"),
+                )
+                started = time.monotonic()
+                ws.run_forever(ping_interval=60, ping_timeout=20)
+                delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 60)
+            except Exception as e:
+                logging.error(f"Error connecting user data stream: {e}")
+                delay = min(delay * 2, 60)
+            self.snapshot.live = False
+            if not self.stopped.is_set():
+                logging.error(f"User data stream disconnected, reconnecting in {delay}s")
+                metrics.inc('retries_total', operation='user_stream')
+                time.sleep(delay)
+
+    def _on_open(self):
+        # События за время разрыва потеряны, поэтому сначала синхронизируемся через REST
+        self.snapshot.refresh()
+        self.snapshot.live = True
+        logging.info("User data stream connected")
+
+    def handle_message(self, message):
+        try:
+            event = json.loads(message)
+            if event.get('e') == 'listenKeyExpired':
+                self.snapshot.live = False
+                return
+            self.snapshot.apply_event(event)
+            for listener in self.listeners:
+                listener(event)
+        except Exception as e:
+            logging.error(f"Error handling user data event: {e}")
+
+# Последние mark price из потока: symbol -> (price, time)
+mark_prices = {}
+signal_queue = queue.Queue()
+
+def clean_symbol(trading_pair):
+    return trading_pair.replace(':USDT', '').replace('/', '')
+
+TELEGRAM_MAX_LENGTH = 4096
+
+class NotificationQueue:
+    # Сообщения уходят в Telegram из фонового потока, торговый код не ждёт сети.
+    # Пачка сообщений за batch_window склеивается в одно, при переполнении сообщение пишется в лог.
+    def __init__(self, send, maxsize=100, batch_window=1.0, min_interval=1.0, max_retries=5):
+        self.send = send
+        self.queue = queue.Queue(maxsize)
+        self.batch_window = batch_window
+        self.min_interval = min_interval
+        self.max_retries = max_retries
+        self.last_sent = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loop = None
+
+    def put(self, message):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='telegram', daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            logging.warning(f"Telegram queue is full, message not sent: {message}")
+
+    def flush(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                for text in self._coalesce(batch):
+                    self._deliver(text)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @staticmethod
+    def _coalesce(batch):
+        # Повторы схлопываются в одну строку со счётчиком, длинные пачки режутся по лимиту Telegram
+        counts = {}
+        for message in batch:
+            counts[message] = counts.get(message, 0) + 1
+        lines = [message if count == 1 else f"{message} (x{count})" for message, count in counts.items()]
+        text = ''
+        for line in lines:
+            line = line[:TELEGRAM_MAX_LENGTH]
+            if text and len(text) + len(line) + 2 > TELEGRAM_MAX_LENGTH:
+                yield text
+                text = ''
+            text = f"{text}\n\n{line}" if text else line
+        if text:
+            yield text
+
+    def _deliver(self, text):
+        for attempt in range(self.max_retries):
+            wait = self.last_sent + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self._send(text)
+                self.last_sent = time.monotonic()
+                logging.info(f"Telegram message sent: {text}")
+                return
+            except telegram.error.RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logging.warning(f"Telegram rate limit hit, retrying in {retry_after}s")
+                time.sleep(retry_after)
+            except Exception as e:
+                logging.error(f"Error sending Telegram message: {e}")
+                return
+        logging.error(f"Telegram message not sent after {self.max_retries} attempts: {text}")
+
+    def _send(self, text):
+        # python-telegram-bot >= 20 асинхронный: корутина выполняется до конца в цикле событий,
+        # принадлежащем потоку-отправителю, поэтому RetryAfter и ошибки сети доходят до _deliver
+        result = self.send(text)
+        if inspect.isawaitable(result):
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+            result = self.loop.run_until_complete(result)
+        return result
+
+def _deliver_telegram_message(text):
+    if not telegram_token or not telegram_chat_id:
+        logging.info(f"Telegram is not configured, message: {text}")
+        return
+    if trading_mode == 'paper':
+        text = f"[paper] {text}"
+    return telegram_bot.send_message(chat_id=telegram_chat_id, text=text)
+
+notifier = NotificationQueue(
+    _deliver_telegram_message,
+    maxsize=settings['telegram_queue_size'],
+    batch_window=settings['telegram_batch_window'],
+)
+atexit.register(notifier.flush)
 
 def send_telegram_message(message):
-    try:
-        telegram_bot.send_message(chat_id=telegram_chat_id, text=message)
-        logging.info(f"Telegram message sent: {message}")
-    except Exception as e:
-        logging.error(f"Error sending Telegram message: {e}")
+    notifier.put(message)
 
-def fetch_ohlcv(symbol, timeframe='15m'):
+@timed('fetch_candles')
+def fetch_candles(symbol, timeframe='15m'):
     try:
-        bars = exchange.fetch_ohlcv(symbol, timeframe=timeframe)
-        df = pd.DataFrame(bars, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
-        return df
+        return candle_store.update(exchange, symbol, timeframe)
     except Exception as e:
-        logging.error(f"Error fetching OHLCV data for {symbol} on {timeframe} timeframe: {e}")
+        logging.error(f"Error updating candle store for {symbol} on {timeframe} timeframe: {e}")
         return None
 
-def calculate_indicators(df):
+@timed('calculate_indicators')
+def calculate_indicators(df, bb_period=14, bb_dev=1, ema_period=4):
     try:
-        df['upper_band'], df['middle_band'], df['lower_band'] = talib.BBANDS(df['close'], timeperiod=14, nbdevup=1, nbdevdn=1)
+        df['upper_band'], df['middle_band'], df['lower_band'] = talib.BBANDS(df['close'], timeperiod=bb_period, nbdevup=bb_dev, nbdevdn=bb_dev)
         df['ao'] = talib.ADOSC(df['high'], df['low'], df['close'], df['volume'])
         df['rsi'] = talib.RSI(df['close'], timeperiod=14)
-        df['ema'] = talib.EMA(df['close'], timeperiod=4)
+        df['ema'] = talib.EMA(df['close'], timeperiod=ema_period)
         return df
     except Exception as e:
         logging.error(f"Error calculating technical indicators: {e}")
         return None
 
-def check_signals(df):
+def get_current_price(client, symbol):
+    mark = mark_prices.get(clean_symbol(symbol))
+    if mark is not None and time.time() - mark[1] < 5:
+        return mark[0]
+    return float(client.get_symbol_ticker(symbol=clean_symbol(symbol))['price'])
+
+INDICATOR_COLUMNS = ['upper_band', 'middle_band', 'lower_band', 'ao', 'rsi', 'ema']
+
+class IndicatorState:
+    # Состояние BBANDS(14, 1), ADOSC(3, 10), RSI(14) и EMA(4) для n символов сразу.
+    # Каждая свеча обновляет его за O(1), формулы и прогрев совпадают с TA-Lib.
+    def __init__(self, n=1, bb_period=14, bb_dev=1.0, rsi_period=14, ema_period=4, fast_period=3, slow_period=10):
+        self.bb_period = bb_period
+        self.bb_dev = bb_dev
+        self.rsi_period = rsi_period
+        self.ema_period = ema_period
+        self.slow_period = slow_period
+        self.fast_k = 2.0 / (fast_period + 1)
+        self.slow_k = 2.0 / (slow_period + 1)
+        self.ema_k = 2.0 / (ema_period + 1)
+        self.count = 0
+        self.window = np.zeros((bb_period, n))
+        self.bb_sum = np.zeros(n)
+        self.bb_sumsq = np.zeros(n)
+        self.ema = np.zeros(n)
+        self.prev_close = np.zeros(n)
+        self.avg_gain = np.zeros(n)
+        self.avg_loss = np.zeros(n)
+        self.ad = np.zeros(n)
+        self.fast = np.zeros(n)
+        self.slow = np.zeros(n)
+
+    def update(self, high, low, close, volume, commit=True):
+        high, low, close, volume = (np.asarray(x, dtype=np.float64) for x in (high, low, close, volume))
+        count = self.count + 1
+        nan = np.full(close.shape, np.nan)
+        out = {}
+
+        # Полосы Боллинджера: скользящие сумма и сумма квадратов по окну
+        slot = self.count % self.bb_period
+        outgoing = self.window[slot] if self.count >= self.bb_period else 0.0
+        bb_sum = self.bb_sum - outgoing + close
+        bb_sumsq = self.bb_sumsq - outgoing * outgoing + close * close
+        if count >= self.bb_period:
+            mean = bb_sum / self.bb_period
+            variance = bb_sumsq / self.bb_period - mean * mean
+            deviation = np.sqrt(np.where(variance > 0, variance, 0.0))
+            out['upper_band'] = mean + self.bb_dev * deviation
+            out['middle_band'] = mean
+            out['lower_band'] = mean - self.bb_dev * deviation
+        else:
+            out['upper_band'] = out['middle_band'] = out['lower_band'] = nan
+
+        # EMA: затравка простым средним первых ema_period значений
+        if count < self.ema_period:
+            ema = self.ema + close
+            out['ema'] = nan
+        elif count == self.ema_period:
+            ema = (self.ema + close) / self.ema_period
+            out['ema'] = ema
+        else:
+            ema = self.ema + self.ema_k * (close - self.ema)
+            out['ema'] = ema
+
+        # RSI: сглаживание Уайлдера, затравка средними за первые rsi_period изменений
+        avg_gain, avg_loss = self.avg_gain, self.avg_loss
+        out['rsi'] = nan
+        if count > 1:
+            change = close - self.prev_close
+            gain = np.where(change > 0, change, 0.0)
+            loss = np.where(change < 0, -change, 0.0)
+            if count <= self.rsi_period:
+                avg_gain, avg_loss = avg_gain + gain, avg_loss + loss
+            else:
+                if count == self.rsi_period + 1:
+                    avg_gain, avg_loss = (avg_gain + gain) / self.rsi_period, (avg_loss + loss) / self.rsi_period
+                else:
+                    avg_gain = (avg_gain * (self.rsi_period - 1) + gain) / self.rsi_period
+                    avg_loss = (avg_loss * (self.rsi_period - 1) + loss) / self.rsi_period
+                total = avg_gain + avg_loss
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    out['rsi'] = np.where(np.abs(total) < 1e-8, 0.0, 100 * avg_gain / total)
+
+        # ADOSC: линия A/D и две EMA от неё, затравленные первым значением
+        spread = high - low
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ad = self.ad + np.where(spread > 0, ((close - low) - (high - close)) / spread * volume, 0.0)
+        if count == 1:
+            fast, slow = ad, ad
+        else:
+            fast = self.fast + self.fast_k * (ad - self.fast)
+            slow = self.slow + self.slow_k * (ad - self.slow)
+        out['ao'] = fast - slow if count >= self.slow_period else nan
+
+        if commit:
+            self.window[slot] = close
+            self.bb_sum, self.bb_sumsq = bb_sum, bb_sumsq
+            if count % (self.bb_period * 64) == 0:
+                # Периодически пересчитываем суммы, чтобы не копилась ошибка округления
+                self.bb_sum = self.window.sum(axis=0)
+                self.bb_sumsq = (self.window * self.window).sum(axis=0)
+            self.ema = ema
+            self.prev_close = close
+            self.avg_gain, self.avg_loss = avg_gain, avg_loss
+            self.ad, self.fast, self.slow = ad, fast, slow
+            self.count = count
+        return out
+
+def batch_indicators(high, low, close, volume, **params):
+    # Пакетный режим: массивы формы (символы, свечи), все символы считаются за один проход
+    high, low, close, volume = (np.atleast_2d(np.asarray(x, dtype=np.float64)) for x in (high, low, close, volume))
+    state = IndicatorState(close.shape[0], **params)
+    result = {column: np.empty(close.shape) for column in INDICATOR_COLUMNS}
+    for i in range(close.shape[1]):
+        out = state.update(high[:, i], low[:, i], close[:, i], volume[:, i])
+        for column in INDICATOR_COLUMNS:
+            result[column][:, i] = out[column]
+    return result
+
+def validate_indicators(df, tolerance=1e-6):
+    # Сравнение инкрементального движка с TA-Lib свеча за свечой
+    expected = calculate_indicators(pd.DataFrame({column: np.asarray(df[column], dtype=np.float64) for column in ['high', 'low', 'close', 'volume']}))
+    actual = batch_indicators(df['high'], df['low'], df['close'], df['volume'])
+    errors = {}
+    for column in INDICATOR_COLUMNS:
+        reference = expected[column].to_numpy()
+        streamed = actual[column][0]
+        if not np.array_equal(np.isnan(reference), np.isnan(streamed)):
+            errors[column] = np.inf
+            continue
+        valid = ~np.isnan(reference)
+        errors[column] = float(np.max(np.abs(reference[valid] - streamed[valid]) / np.maximum(np.abs(reference[valid]), 1.0), initial=0.0))
+    for column, error in errors.items():
+        if error > tolerance:
+            logging.error(f"Streaming {column} differs from TA-Lib by {error}")
+    return errors
+
+class StreamingIndicators:
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def latest(self, symbol, timeframe, candles, forming):
+        # Возвращает значения индикаторов для двух последних свечей в виде, который понимает check_signals()
+        timestamps = candles['timestamp']
+        closed = len(timestamps) - 1 if forming else len(timestamps)
+        with self.lock:
+            entry = self.states.get((symbol, timeframe))
+        if entry is None or closed == 0 or entry['last_time'] < timestamps[0] or entry['last_time'] > timestamps[closed - 1]:
+            # Первый запуск или разрыв в истории: прогреваем состояние заново
+            entry = {'state': IndicatorState(), 'last_time': -1, 'history': deque(maxlen=2)}
+            with self.lock:
+                self.states[(symbol, timeframe)] = entry
+
+        state = entry['state']
+        start = int(np.searchsorted(timestamps[:closed], entry['last_time'], side='right'))
+        for i in range(start, closed):
+            out = state.update(candles['high'][i], candles['low'][i], candles['close'][i], candles['volume'][i])
+            entry['history'].append({**out, 'close': candles['close'][i]})
+        if closed > start:
+            entry['last_time'] = timestamps[closed - 1]
+
+        rows = list(entry['history'])
+        if forming:
+            out = state.update(candles['high'][-1], candles['low'][-1], candles['close'][-1], candles['volume'][-1], commit=False)
+            rows = rows[-1:] + [{**out, 'close': candles['close'][-1]}]
+        if len(rows) < 2:
+            return None
+        return {column: np.array([float(np.asarray(row[column]).ravel()[0]) for row in rows]) for column in INDICATOR_COLUMNS + ['close']}
+
+streaming_indicators = StreamingIndicators()
+
+def trend_direction(row, rsi_threshold=50):
+    # Направление тренда старшего таймфрейма: EMA и RSI по одну сторону от средней полосы и порога
+    if row['ema'] > row['middle_band'] and row['rsi'] > rsi_threshold:
+        return 'LONG'
+    if row['ema'] < row['middle_band'] and row['rsi'] < rsi_threshold:
+        return 'SHORT'
+    return None
+
+def _row(df, index):
+    if isinstance(df, dict):
+        return {column: values[index] for column, values in df.items()}
+    return df.iloc[index]
+
+def signal_conditions(previous, latest, rsi_threshold=50):
+    # Работает и со скалярами одной свечи, и с массивами всей истории (бэктест)
+    buy_signal = (
+        (previous['ema'] <= previous['middle_band']) & (latest['ema'] > latest['middle_band']) &
+        (previous['ao'] <= 0) & (latest['ao'] > 0) &
+        (previous['rsi'] <= rsi_threshold) & (latest['rsi'] > rsi_threshold)
+    )
+
+    sell_signal = (
+        (previous['ema'] >= previous['middle_band']) & (latest['ema'] < latest['middle_band']) &
+        (previous['ao'] >= 0) & (latest['ao'] < 0) &
+        (previous['rsi'] >= rsi_threshold) & (latest['rsi'] < rsi_threshold)
+    )
+    return buy_signal, sell_signal
+
+@timed('check_signals')
+def check_signals(df, confirmations=None):
     try:
-        latest = df.iloc[-1]
-        previous = df.iloc[-2]
-
-        buy_signal = (
-            previous['ema'] <= previous['middle_band'] and latest['ema'] > latest['middle_band'] and
-            previous['ao'] <= 0 and latest['ao'] > 0 and
-            previous['rsi'] <= 50 and latest['rsi'] > 50
-        )
+        latest = _row(df, -1)
+        previous = _row(df, -2)
 
-        sell_signal = (
-            previous['ema'] >= previous['middle_band'] and latest['ema'] < latest['middle_band'] and
-            previous['ao'] >= 0 and latest['ao'] < 0 and
-            previous['rsi'] >= 50 and latest['rsi'] < 50
-        )
+        buy_signal, sell_signal = signal_conditions(previous, latest)
 
         if buy_signal:
             position_side = 'LONG'
-            return "LONG", latest['close'], position_side
         elif sell_signal:
             position_side = 'SHORT'
-            return "SHORT", latest['close'], position_side
         else:
             return None, None, None
+
+        # Сигнал проходит, только если тренд на всех старших таймфреймах в ту же сторону
+        for timeframe, frame in (confirmations or {}).items():
+            if frame is None or trend_direction(_row(frame, -1)) != position_side:
+                logging.info(f"{position_side} signal not confirmed on {timeframe}")
+                metrics.inc('signals_filtered_total', timeframe=timeframe)
+                return None, None, None
+        return position_side, latest['close'], position_side
     except Exception as e:
         logging.error(f"Error checking signals: {e}")
         return None, None, None
 
+@timed('get_symbol_info')
 def get_symbol_info(client, trading_pair):
     try:
         trading_pair = trading_pair.replace(':USDT', '').replace('/', '')  # Clean symbol
-        symbol_info = client.futures_exchange_info()
-        for symbol in symbol_info['symbols']:
-            if symbol['symbol'] == trading_pair:
-                step_size = float(symbol['filters'][1]['stepSize'])
-                tick_size = float(symbol['filters'][0]['tickSize'])
-                min_notional = float(symbol['filters'][5]['notional'])
-                return step_size, tick_size, min_notional
+        symbol = symbol_metadata.get(client, trading_pair)
+        if symbol is not None:
+            return symbol['step_size'], symbol['tick_size'], symbol['min_notional']
         logging.error(f"Symbol info not found for {trading_pair}.")
         return None, None, None
     except Exception as e:
@@ -144,10 +1649,9 @@ def get_symbol_info(client, trading_pair):
 def set_margin_mode(client, trading_pair, margin_mode):
     try:
         trading_pair = trading_pair.replace(':USDT', '').replace('/', '')  # Clean symbol
-        if margin_mode.lower() == 'isolated':
-            client.futures_change_margin_type(symbol=trading_pair, marginType='ISOLATED')
-        elif margin_mode.lower() == 'cross':
-            client.futures_change_margin_type(symbol=trading_pair, marginType='CROSSED')
+        margin_type = MARGIN_TYPES.get(margin_mode.lower())
+        if margin_type is not None:
+            client.futures_change_margin_type(symbol=trading_pair, marginType=margin_type)
         else:
             logging.error(f"Invalid margin mode: {margin_mode}")
             exit()
@@ -160,9 +1664,7 @@ def set_margin_mode(client, trading_pair, margin_mode):
 
 def get_account_balance(client):
     try:
-        account_info = client.futures_account()
-        balance = float(account_info['totalWalletBalance'])
-        return balance
+        return get_account_snapshot(client).get_balance()
     except Exception as e:
         logging.error(f"Error fetching account balance: {e}")
         exit()
@@ -209,13 +1711,7 @@ def calculate_prices(current_price, take_profit_percent, stop_loss_percent, posi
 
 def count_open_positions(client, position_side):
     try:
-        account_info = client.futures_account()
-        positions = account_info['positions']
-        count = 0
-        for pos in positions:
-            if pos['positionSide'] == position_side and float(pos['positionAmt']) != 0:
-                count += 1
-        return count
+        return len(get_account_snapshot(client).open_positions(position_side))
     except Exception as e:
         logging.error(f"Error counting open positions: {e}")
         return None
@@ -232,8 +1728,9 @@ def cancel_all_orders(client, trading_pair):
 
 def cleanup_orders(client):
     try:
+        snapshot = get_account_snapshot(client)
         # Получаем список всех открытых ордеров
-        open_orders = client.futures_get_open_orders()
+        open_orders = snapshot.open_orders()
         # Создаем словарь, чтобы отслеживать ордера по символам
         orders_by_symbol = {}
         for order in open_orders:
@@ -244,136 +1741,342 @@ def cleanup_orders(client):
         
         # Проверяем позиции по каждому символу
         for symbol, orders in orders_by_symbol.items():
-            open_positions = client.futures_position_information(symbol=symbol)
-            has_open_position = any(float(pos['positionAmt']) != 0 for pos in open_positions)
+            has_open_position = snapshot.has_position(symbol)
 
             # Удаляем ордера, если позиции нет
             if not has_open_position:
                 for order in orders:
                     if order['type'] in ['TAKE_PROFIT_MARKET', 'STOP_MARKET']:
                         client.futures_cancel_order(symbol=symbol, orderId=order['orderId'])
+                        snapshot.remove_order(symbol, order['orderId'])
                         logging.info(f"Removed {order['type']} order for {symbol} as no open position exists.")
     except Exception as e:
         logging.error(f"Error cleaning up orders: {e}")
 
-def ensure_stop_loss_take_profit(client):
-    try:
-        # Получаем список всех открытых позиций
-        open_positions = client.futures_position_information()
-        for pos in open_positions:
-            symbol = pos['symbol']
-            position_amt = float(pos['positionAmt'])
-            entry_price = float(pos['entryPrice'])
-            if position_amt == 0:
-                continue
+class ProtectionManager:
+    # Защита позиций по событиям: ORDER_TRADE_UPDATE/ACCOUNT_UPDATE из user-data потока и mark price.
+    # Позиция проверяется только когда по ней что-то изменилось; стоп на нужной цене повторно не ставится.
+    def __init__(self, client):
+        self.client = client
+        self.snapshot = get_account_snapshot(client)
+        self.lock = threading.Lock()
+        # (symbol, positionSide) -> {'amount', 'entry_price', 'breakeven'}
+        self.positions = {}
+        self.pending = set()
+        self.worker = ThreadPoolExecutor(1, 'protection')
+        self.reconciled_at = 0
+
+    def on_user_event(self, event):
+        if event.get('e') == 'ACCOUNT_UPDATE':
+            keys = [(pos['s'], pos['ps']) for pos in event['a'].get('P', [])]
+        elif event.get('e') == 'ORDER_TRADE_UPDATE':
+            keys = [(event['o']['s'], event['o']['ps'])]
+        else:
+            return
+        for key in keys:
+            self.schedule(key)
+
+    def on_mark_price(self, symbol, price):
+        # Вызывается на каждое обновление mark price, поэтому без запросов и блокировок
+        for side in ('LONG', 'SHORT', 'BOTH'):
+            state = self.positions.get((symbol, side))
+            if state is not None and not state['breakeven'] and self._roi(state, price) > BREAKEVEN_ROI:
+                self.schedule((symbol, side), price)
+
+    def schedule(self, key, price=None):
+        # Пока позиция в очереди, новые события по ней не добавляют работы
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.worker.submit(self._run, key, price)
 
-            # Получаем текущие ордера по символу
-            open_orders = client.futures_get_open_orders(symbol=symbol)
-            has_take_profit = any(order['type'] == 'TAKE_PROFIT_MARKET' for order in open_orders)
-            has_stop_loss = any(order['type'] == 'STOP_MARKET' for order in open_orders)
-
-            # Вычисляем текущий ROI
-            ticker = client.get_symbol_ticker(symbol=symbol)
-            current_price = float(ticker['price'])
-            roi = ((current_price - entry_price) / entry_price) * 100 * leverage if pos['positionSide'] == 'LONG' else ((entry_price - current_price) / entry_price) * 100 *leverage
-            print(symbol,roi)
-            if roi >15:
-                stop_loss_price = entry_price
-                # Создаем стоп-лосс ордер
-                client.futures_create_order(
-                    symbol=symbol,
-                    side='SELL' if pos['positionSide'] == 'LONG' else 'BUY',
-                    type='STOP_MARKET',
-                    quantity=abs(position_amt),
-                    stopPrice=stop_loss_price,
-                    positionSide=pos['positionSide']
-                )
-                message=(f"Updated STOP_LOSS order for {symbol} to breakeven at price {stop_loss_price}")
-                send_telegram_message(message)
-
-            if not has_take_profit or not has_stop_loss:
-                step_size, tick_size, min_notional = get_symbol_info(client, symbol)
-                balance = get_account_balance(client)
-                position_size = calculate_position_size(balance, position_size_percent, leverage, current_price, step_size, min_notional)
-                take_profit_price, stop_loss_price = calculate_prices(current_price, take_profit_percent, stop_loss_percent, pos['positionSide'], tick_size)
-
-                if not has_take_profit:
-                    client.futures_create_order(
-                        symbol=symbol,
-                        side='SELL' if pos['positionSide'] == 'LONG' else 'BUY',
-                        type='TAKE_PROFIT_MARKET',
-                        quantity=position_size,
-                        stopPrice=take_profit_price,
-                        
-                        positionSide=pos['positionSide']
-                    )
+    def _run(self, key, price):
+        with self.lock:
+            self.pending.discard(key)
+        try:
+            with get_account(self.client).lock:
+                self.sync(key, price)
+        except Exception as e:
+            logging.error(f"Error protecting position {key[0]} {key[1]}: {e}")
+
+    def reconcile(self):
+        # Полная сверка по снимку аккаунта: при старте и в режиме без user-data потока
+        keys = set(self.positions) | {(pos['symbol'], pos['positionSide']) for pos in self.snapshot.open_positions()}
+        for key in keys:
+            self.sync(key)
+        self.reconciled_at = time.monotonic()
+
+    def _roi(self, state, price):
+        entry_price = state['entry_price']
+        change = (price - entry_price) if state['amount'] > 0 else (entry_price - price)
+        return change / entry_price * 100 * get_account(self.client).settings['leverage']
+
+    def sync(self, key, price=None):
+        symbol, side = key
+        with self.snapshot.lock:
+            pos = self.snapshot.positions.get(key)
+        orders = [order for order in self.snapshot.open_orders(symbol)
+                  if order['type'] in ('TAKE_PROFIT_MARKET', 'STOP_MARKET') and order.get('positionSide', side) == side]
+
+        if pos is None:
+            # Позиция закрыта: оставшиеся TP/SL больше ничего не защищают
+            self.positions.pop(key, None)
+            for order in orders:
+                self.client.futures_cancel_order(symbol=symbol, orderId=order['orderId'])
+                self.snapshot.remove_order(symbol, order['orderId'])
+                logging.info(f"Removed {order['type']} order for {symbol} as no open position exists.")
+            return
+
+        step_size, tick_size, min_notional = get_symbol_info(self.client, symbol)
+        if tick_size is None:
+            return
+        amount = float(pos['positionAmt'])
+        entry_price = float(pos['entryPrice'])
+        breakeven_price = round(entry_price - (entry_price % tick_size), 5)
+        stops = [order for order in orders if order['type'] == 'STOP_MARKET']
+        take_profits = [order for order in orders if order['type'] == 'TAKE_PROFIT_MARKET']
+        state = self.positions[key] = {
+            'amount': amount,
+            'entry_price': entry_price,
+            'breakeven': any(abs(float(order['stopPrice']) - breakeven_price) < tick_size / 2 for order in stops),
+        }
+        if state['breakeven'] and take_profits:
+            return
+
+        current_price = price if price is not None else get_current_price(self.client, symbol)
+        direction = 'LONG' if amount > 0 else 'SHORT'
+        if not state['breakeven'] and self._roi(state, current_price) > BREAKEVEN_ROI:
+            if self.replace_stop(symbol, side, amount, breakeven_price, stops, tick_size):
+                state['breakeven'] = True
+                send_telegram_message(f"Updated STOP_LOSS order for {symbol} to breakeven at price {breakeven_price}")
+                stops = []
+
+        if not stops or not take_profits:
+            settings = get_account(self.client).settings
+            take_profit_price, stop_loss_price = calculate_prices(current_price, settings['take_profit_percent'], settings['stop_loss_percent'], direction, tick_size)
+            exit_side = 'SELL' if amount > 0 else 'BUY'
+            if not take_profits:
+                params = _order_params(symbol, exit_side, 'TAKE_PROFIT_MARKET', abs(amount), side, take_profit_price)
+                if _place_order_with_retries(self.client, params)[0] is not None:
                     logging.info(f"Created TAKE_PROFIT order for {symbol} at {take_profit_price}")
-
-                if not has_stop_loss:
-                    client.futures_create_order(
-                        symbol=symbol,
-                        side='SELL' if pos['positionSide'] == 'LONG' else 'BUY',
-                        type='STOP_MARKET',
-                        quantity=position_size,
-                        stopPrice=stop_loss_price,
-                        
-                        positionSide=pos['positionSide']
-                    )
+            if not stops and not state['breakeven']:
+                params = _order_params(symbol, exit_side, 'STOP_MARKET', abs(amount), side, stop_loss_price)
+                if _place_order_with_retries(self.client, params)[0] is not None:
                     logging.info(f"Created STOP_LOSS order for {symbol} at {stop_loss_price}")
 
+    def replace_stop(self, symbol, side, amount, stop_price, stops, tick_size):
+        # Идемпотентно: если стоп на этой цене уже стоит, ничего не делаем.
+        # Сначала новый стоп, потом отмена старых, чтобы позиция не оставалась без защиты.
+        if any(abs(float(order['stopPrice']) - stop_price) < tick_size / 2 for order in stops):
+            return True
+        exit_side = 'SELL' if amount > 0 else 'BUY'
+        params = _order_params(symbol, exit_side, 'STOP_MARKET', abs(amount), side, stop_price)
+        if _place_order_with_retries(self.client, params)[0] is None:
+            return False
+        for order in stops:
+            self.client.futures_cancel_order(symbol=symbol, orderId=order['orderId'])
+            self.snapshot.remove_order(symbol, order['orderId'])
+        logging.info(f"Moved STOP_LOSS for {symbol} {side} to {stop_price}, replaced {len(stops)} order(s)")
+        return True
+
+protection_managers = {}
+
+def get_protection_manager(client):
+    manager = protection_managers.get(client)
+    if manager is None:
+        manager = protection_managers[client] = ProtectionManager(client)
+    return manager
+
+def ensure_stop_loss_take_profit(client):
+    try:
+        get_protection_manager(client).reconcile()
     except Exception as e:
         logging.error(f"Error ensuring stop loss and take profit orders: {e}")
 
-
-
 def cancel_take_profit_stop_loss_orders(client, trading_pair):
     try:
         trading_pair = trading_pair.replace(':USDT', '').replace('/', '')  # Clean symbol
-        open_orders = client.futures_get_open_orders(symbol=trading_pair)
+        snapshot = get_account_snapshot(client)
+        open_orders = snapshot.open_orders(trading_pair)
         for order in open_orders:
             if order['type'] in ['TAKE_PROFIT_MARKET', 'STOP_MARKET']:
                 client.futures_cancel_order(symbol=trading_pair, orderId=order['orderId'])
+                snapshot.remove_order(trading_pair, order['orderId'])
                 logging.info(f"Cancelled {order['type']} order for {trading_pair}.")
     except Exception as e:
         logging.error(f"Error cancelling take profit and stop loss orders for {trading_pair}: {e}")
 
+def _order_params(trading_pair, side, order_type, quantity, position_side_setting, stop_price=None):
+    params = {
+        'symbol': trading_pair,
+        'side': side,
+        'type': order_type,
+        'quantity': str(quantity),
+        'positionSide': position_side_setting,
+        # Свой clientOrderId: повтор после потерянного ответа находит принятый ордер (_find_order)
+        'newClientOrderId': uuid.uuid4().hex,
+    }
+    if stop_price is not None:
+        params['stopPrice'] = str(stop_price)
+    return params
+
+# Binance: ордер с таким clientOrderId не найден
+ORDER_NOT_FOUND = -2013
+
+def _find_order(client, symbol, client_order_id):
+    # Ордер, ответ на который потерян при сетевой ошибке, ищется по своему clientOrderId:
+    # повтор с тем же id биржа отклонит как дубликат, а без id он откроет вторую позицию
+    try:
+        return client.futures_get_order(symbol=symbol, origClientOrderId=client_order_id)
+    except Exception as e:
+        if getattr(e, 'code', None) == ORDER_NOT_FOUND:
+            return None
+        raise
+
+def _place_order_with_retries(client, params, max_retries=5):
+    account = get_account(client)
+    for attempt in range(max_retries):
+        started = time.perf_counter()
+        try:
+            order = _find_order(client, params['symbol'], params['newClientOrderId']) if attempt else None
+            if order is None:
+                account.order_budget.acquire(1)
+                order = client.futures_create_order(**params)
+            latency = (time.perf_counter() - started) * 1000
+            logging.info(order)
+            get_account_snapshot(client).add_order(order)
+            account.state_store.record_order(order)
+            return order, latency
+        except Exception as e:
+            if not is_retryable(e):
+                logging.error(f"Error creating {params['type']} order for {params['symbol']}: {e}")
+                return None, (time.perf_counter() - started) * 1000
+            logging.error(f"Error creating {params['type']} order: {e}. Attempt {attempt + 1} of {max_retries}")
+            metrics.inc('retries_total', operation=params['type'])
+            time.sleep(backoff_delay(attempt))
+    return None, None
+
+def _place_protective_orders(client, legs):
+    # TP и SL уходят параллельно: позиция без стопа живёт один сетевой round trip, а не два
+    futures = {label: order_pool.submit(_place_order_with_retries, client, params) for label, params in legs.items()}
+    return {label: future.result() for label, future in futures.items()}
+
+@timed('create_orders')
 def create_orders(client, trading_pair, position_size, take_profit_price, stop_loss_price, position_side_setting, position_side):
     max_retries = 5
     trading_pair = trading_pair.replace(':USDT', '').replace('/', '')  # Clean symbol
+    account = get_account(client)
+    open_orders = account.open_orders
+    state_store = account.state_store
+
+    # Check for existing order
+    if trading_pair in open_orders and (datetime.now() - open_orders[trading_pair]).total_seconds() < ORDER_DEDUP_SECONDS:
+        logging.info(f"Order for pair {trading_pair} already exists. Skipping...")
+        return
+
+    # Check number of open positions
+    if position_side not in ('LONG', 'SHORT'):
+        logging.error(f"Invalid position_side: {position_side}")
+        return
+    open_positions_count = count_open_positions(client, position_side)
+    if open_positions_count is None or open_positions_count >= MAX_POSITIONS_PER_SIDE:
+        logging.info(f"Exceeded number of open {position_side} positions. Skipping...")
+        return
+
+    # Ensure take profit and stop loss prices are valid before entering
+    current_price = get_current_price(client, trading_pair)
+    if (position_side == 'LONG' and (take_profit_price <= current_price or stop_loss_price >= current_price)) or \
+       (position_side == 'SHORT' and (take_profit_price >= current_price or stop_loss_price <= current_price)):
+        logging.error(f"Invalid take profit or stop loss price for {position_side} order: {trading_pair}")
+        return
+
+    # Cancel existing take profit and stop loss orders
+    cancel_take_profit_stop_loss_orders(client, trading_pair)
+
+    entry_side = 'BUY' if position_side == 'LONG' else 'SELL'
+    exit_side = 'SELL' if position_side == 'LONG' else 'BUY'
+    entry = _order_params(trading_pair, entry_side, 'MARKET', position_size, position_side_setting)
+    legs = {
+        'take_profit': _order_params(trading_pair, exit_side, 'TAKE_PROFIT_MARKET', position_size, position_side_setting, take_profit_price),
+        'stop_loss': _order_params(trading_pair, exit_side, 'STOP_MARKET', position_size, position_side_setting, stop_loss_price),
+    }
+
+    # Намерение фиксируется до отправки: если процесс упадёт посреди входа, сверка при старте его разрешит
+    intent_id = state_store.add_intent(trading_pair, position_side, {'entry': entry, **legs})
 
     for attempt in range(max_retries):
         try:
-            # Check for existing order
-            if trading_pair in open_orders and (datetime.now() - open_orders[trading_pair]).total_seconds() < 43200:  # 12 hours = 43200 seconds
-                logging.info(f"Order for pair {trading_pair} already exists. Skipping...")
-                return
-
-            # Check number of open positions
-            if position_side == 'LONG':
-                open_positions_count = count_open_positions(client, 'LONG')
-            elif position_side == 'SHORT':
-                open_positions_count = count_open_positions(client, 'SHORT')
+            started = time.perf_counter()
+            latencies = {}
+            previous = _find_order(client, trading_pair, entry['newClientOrderId']) if attempt else None
+            if previous is not None:
+                # Прошлая попытка дошла до биржи, ответ потерян: вход уже исполнен, доставляем недостающие TP/SL
+                logging.warning(f"Entry for {trading_pair} was placed by a previous attempt: {previous}")
+                market_order = previous
+                placed, missing = {}, {}
+                for label, params in legs.items():
+                    order = _find_order(client, trading_pair, params['newClientOrderId'])
+                    if order is None:
+                        missing[label] = params
+                    else:
+                        placed[label] = order
+                        get_account_snapshot(client).add_order(order)
+                        state_store.record_order(order)
+                for label, (order, leg_latency) in _place_protective_orders(client, missing).items():
+                    placed[label] = order or {}
+                    latencies[label] = leg_latency
+            elif batch_orders_enabled:
+                # Вход, TP и SL одним запросом batchOrders
+                # batchOrders считается в лимите ордеров по числу ордеров в пакете
+                account.order_budget.acquire(1 + len(legs))
+                results = client.futures_place_batch_order(batchOrders=[entry] + list(legs.values()))
+                latency = (time.perf_counter() - started) * 1000
+                market_order = results[0]
+                placed = dict(zip(legs, results[1:]))
+                latencies = {label: latency for label in ['entry'] + list(legs)}
+                if 'orderId' not in market_order:
+                    logging.error(f"Market order for {trading_pair} rejected: {market_order}")
+                    for label, order in placed.items():
+                        if 'orderId' in order:
+                            client.futures_cancel_order(symbol=trading_pair, orderId=order['orderId'])
+                    state_store.update_intent(intent_id, 'rejected')
+                    return
+                failed = {}
+                for label, order in placed.items():
+                    if 'orderId' in order:
+                        get_account_snapshot(client).add_order(order)
+                        state_store.record_order(order)
+                    else:
+                        logging.error(f"{label} order for {trading_pair} rejected in batch: {order}")
+                        failed[label] = legs[label]
+                for label, (order, leg_latency) in _place_protective_orders(client, failed).items():
+                    placed[label] = order or {}
+                    latencies[label] = leg_latency
             else:
-                logging.error(f"Invalid position_side: {position_side}")
-                return
+                account.order_budget.acquire(1)
+                market_order = client.futures_create_order(**entry)
+                latencies['entry'] = (time.perf_counter() - started) * 1000
+                placed = {}
+                for label, (order, leg_latency) in _place_protective_orders(client, legs).items():
+                    placed[label] = order or {}
+                    latencies[label] = leg_latency
+            exposure = (time.perf_counter() - started) * 1000
 
-            if open_positions_count is None or open_positions_count >= 5:
-                logging.info(f"Exceeded number of open {position_side} positions. Skipping...")
-                return
-
-            # Create market order
-            market_order = client.futures_create_order(
-                symbol=trading_pair,
-                side=Client.SIDE_BUY if position_side == 'LONG' else Client.SIDE_SELL,
-                type=Client.ORDER_TYPE_MARKET,
-                quantity=position_size,
-                positionSide=position_side_setting
-            )
             logging.info("Market order successfully created:")
             logging.info(market_order)
+            logging.info(
+                f"Order latency for {trading_pair}: "
+                + ", ".join(f"{label} {value:.0f}ms" if value is not None else f"{label} failed" for label, value in latencies.items())
+                + f", protected after {exposure:.0f}ms"
+            )
 
             # Record order open time
             open_orders[trading_pair] = datetime.now()
+            state_store.record_entry(trading_pair)
+            state_store.record_order(market_order)
+            state_store.update_intent(intent_id, 'placed', market_order.get('orderId'))
+            get_account_snapshot(client).invalidate()
 
             # Send Telegram message and log account balance and order details
             balance = get_account_balance(client)
@@ -385,139 +2088,1503 @@ def create_orders(client, trading_pair, position_size, take_profit_price, stop_l
                 f"Current balance: {balance} USDT"
             )
             send_telegram_message(message)
+            if 'orderId' in placed.get('take_profit', {}):
+                send_telegram_message("Take profit order created for pair " + trading_pair)
+            if 'orderId' in placed.get('stop_loss', {}):
+                send_telegram_message("Stop loss order created for pair " + trading_pair)
+            return
 
-            # Ensure take profit and stop loss prices are valid
-            current_price = float(client.get_symbol_ticker(symbol=trading_pair)['price'])
-            if (position_side == 'LONG' and (take_profit_price <= current_price or stop_loss_price >= current_price)) or \
-               (position_side == 'SHORT' and (take_profit_price >= current_price or stop_loss_price <= current_price)):
-                logging.error(f"Invalid take profit or stop loss price for {position_side} order: {trading_pair}")
-                return
+        except Exception as e:
+            if not is_retryable(e):
+                state_store.update_intent(intent_id, 'failed')
+                raise
+            send_telegram_message(f"Error creating order: {e}. Attempt {attempt + 1} of {max_retries}")
+            metrics.inc('retries_total', operation='create_orders')
+            time.sleep(backoff_delay(attempt))  # Pause before retrying
 
-            # Cancel existing take profit and stop loss orders
-            cancel_take_profit_stop_loss_orders(client, trading_pair)
+    state_store.update_intent(intent_id, 'failed')
+    logging.error(f"Failed to create orders after {max_retries} attempts.")
 
-            # Create take profit order
-            for attempt_tp in range(max_retries):
-                try:
-                    tp_order = client.futures_create_order(
-                        symbol=trading_pair,
-                        side=Client.SIDE_SELL if position_side == 'LONG' else Client.SIDE_BUY,
-                        type="TAKE_PROFIT_MARKET",
-                        quantity=position_size,
-                        stopPrice=take_profit_price,
-                        positionSide=position_side_setting
-                    )
-                    message = "Take profit order created for pair " + trading_pair
-                    send_telegram_message(message)
-                    logging.info(tp_order)
-                    break
-                except (ConnectionError, HTTPError) as e:
-                    logging.error(f"Error creating take profit order: {e}. Attempt {attempt_tp + 1} of {max_retries}")
-                    time.sleep(5)
-                    continue
 
-            # Create stop loss order
-            for attempt_sl in range(max_retries):
-                try:
-                    sl_order = client.futures_create_order(
-                        symbol=trading_pair,
-                        side=Client.SIDE_SELL if position_side == 'LONG' else Client.SIDE_BUY,
-                        type="STOP_MARKET",
-                        quantity=position_size,
-                        stopPrice=stop_loss_price,
-                        positionSide=position_side_setting
-                    )
-                    message = "Stop loss order created for pair " + trading_pair
-                    send_telegram_message(message)
-                    logging.info(sl_order)
-                    break
-                except (ConnectionError, HTTPError) as e:
-                    logging.error(f"Error creating stop loss order: {e}. Attempt {attempt_sl + 1} of {max_retries}")
-                    time.sleep(5)
-                    continue
+def resample_candles(candles, source_ms, target_ms, forming=False):
+    # Агрегация свечей младшего таймфрейма в старший по границам UTC (до 1d включительно).
+    # Неполная первая корзина отбрасывается; неполная последняя остаётся только как формирующаяся свеча.
+    timestamps = candles['timestamp']
+    if target_ms == source_ms or len(timestamps) == 0:
+        return candles
+    buckets = timestamps - timestamps % target_ms
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(timestamps)]
+    first = 0 if timestamps[0] == buckets[0] else 1
+    complete = timestamps[-1] + source_ms >= buckets[-1] + target_ms
+    stop = len(starts) if forming or complete else len(starts) - 1
+    resampled = {
+        'timestamp': buckets[starts],
+        'open': candles['open'][starts],
+        'high': np.maximum.reduceat(candles['high'], starts),
+        'low': np.minimum.reduceat(candles['low'], starts),
+        'close': candles['close'][ends - 1],
+        'volume': np.add.reduceat(candles['volume'], starts),
+    }
+    return {column: values[first:stop] for column, values in resampled.items()}
+
+def timeframe_candles(candles, source_timeframe, timeframe, forming=False):
+    return resample_candles(candles, parse_timeframe(source_timeframe) * 1000, parse_timeframe(timeframe) * 1000, forming)
+
+def indicator_frame(candles, symbol=None, timeframe='15m', forming=False):
+    if indicator_engine == 'streaming' and symbol is not None:
+        try:
+            return streaming_indicators.latest(symbol, timeframe, candles, forming)
+        except Exception as e:
+            logging.error(f"Error updating streaming indicators for {symbol} on {timeframe}: {e}")
+            return None
+    return calculate_indicators(dict(candles))
+
+def confirmation_frames(symbol, candles, source_timeframe, forming=False):
+    # Индикаторы старших таймфреймов по закрытым свечам; состояние streaming-движка своё для каждого таймфрейма
+    if forming:
+        candles = {column: values[:-1] for column, values in candles.items()}
+    return {
+        timeframe: indicator_frame(timeframe_candles(candles, source_timeframe, timeframe), symbol, timeframe)
+        for timeframe in confirm_timeframes
+    }
+
+def evaluate_candles(candles, symbol=None, timeframe='15m', forming=False, confirmations=None):
+    df = indicator_frame(candles, symbol, timeframe, forming)
+    if df is None:
+        return None, None, None
+    return check_signals(df, confirmations)
+
+STREAM_URL = 'wss://fstream.binance.com/stream?streams='
+STREAMS_PER_CONNECTION = 200
+
+class MarketStream:
+    def __init__(self, symbols, timeframe='15m', on_signal=None, record_path='', on_mark_price=None):
+        # Имя потока Binance -> символ ccxt
+        self.symbols = {clean_symbol(symbol).lower(): symbol for symbol in symbols}
+        self.timeframe = timeframe
+        self.on_signal = on_signal or (lambda *signal: signal_queue.put(signal))
+        self.on_mark_price = on_mark_price
+        self.record_path = record_path
+        self.record_lock = threading.Lock()
+        self.last_closed = {}
+        self.active = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        streams = [f"{name}@kline_{self.timeframe}" for name in self.symbols]
+        streams.insert(0, '!markPrice@arr@1s')
+        for i in range(0, len(streams), STREAMS_PER_CONNECTION):
+            chunk = streams[i:i + STREAMS_PER_CONNECTION]
+            thread = threading.Thread(target=self._run, args=(chunk,), name=f"stream-{i // STREAMS_PER_CONNECTION}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self, streams):
+        url = STREAM_URL + '/'.join(streams)
+        names = [stream.split('@')[0] for stream in streams if stream.split('@')[0] in self.symbols]
+        state = {'connected': False}
+        delay = 1
+
+        def on_open(ws):
+            logging.info(f"Stream connected: {len(streams)} streams")
+            if state['connected']:
+                # После переподключения догружаем пропущенные свечи через REST
+                threading.Thread(target=self.backfill, args=(names,), daemon=True).start()
+            state['connected'] = True
+
+        while not self.stopped.is_set():
+            ws = websocket.WebSocketApp(
+                url,
+                on_open=on_open,
+                on_message=lambda ws, message: self.handle_message(message),
+                on_error=lambda ws, error: logging.error(f"Stream error: {error}"),
+            )
+            started = time.monotonic()
+            ws.run_forever(ping_interval=60, ping_timeout=20)
+            if self.stopped.is_set():
+                break
+            delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 60)
+            logging.error(f"Stream disconnected, reconnecting in {delay}s")
+            metrics.inc('retries_total', operation='market_stream')
+            time.sleep(delay)
+
+    def backfill(self, names):
+        # После переподключения догружаем свечи только отобранных скринером символов:
+        # остальные всё равно не оцениваются, а их klines стоили бы ~1000 веса на чанк
+        for name in names:
+            symbol = self.symbols[name]
+            if self.active is not None and symbol not in self.active:
+                continue
+            if fetch_candles(symbol, self.timeframe) is not None:
+                self.evaluate(symbol, exchange.milliseconds())
 
-            return  # Exit loop if all orders are successfully created
+    def handle_message(self, message):
+        try:
+            if self.record_path:
+                with self.record_lock, open(self.record_path, 'a') as f:
+                    f.write(message.rstrip('\n') + '\n')
+            payload = json.loads(message)
+            data = payload.get('data', payload)
+            if isinstance(data, list):
+                for item in data:
+                    if item.get('e') == 'markPriceUpdate':
+                        mark_prices[item['s']] = (float(item['p']), item['E'] / 1000)
+                        if self.on_mark_price:
+                            self.on_mark_price(item['s'], float(item['p']))
+            elif data.get('e') == 'kline':
+                self.handle_kline(data)
+        except Exception as e:
+            logging.error(f"Error handling stream message: {e}")
+
+    def handle_kline(self, data):
+        symbol = self.symbols.get(data['s'].lower())
+        if symbol is None:
+            return
+        k = data['k']
+        bar = [k['t'], float(k['o']), float(k['h']), float(k['l']), float(k['c']), float(k['v'])]
+        candle_store.apply_kline(symbol, self.timeframe, bar)
+        if k['x']:
+            self.evaluate(symbol, k['T'] + 1)
+
+    def evaluate(self, symbol, closed_before):
+        if self.active is not None and symbol not in self.active:
+            return
+        candles = candle_store.closed(symbol, self.timeframe, closed_before)
+        if candles is None:
+            return
+        # Свеча signal_timeframe закрывается не на каждой свече потока
+        signal_candles = timeframe_candles(candles, self.timeframe, signal_timeframe)
+        if len(signal_candles['timestamp']) < 2:
+            return
+        bar_time = signal_candles['timestamp'][-1]
+        if self.last_closed.get(symbol, -1) >= bar_time:
+            return
+        self.last_closed[symbol] = bar_time
+        signal, price, position_side = evaluate_candles(
+            signal_candles, symbol, signal_timeframe, confirmations=confirmation_frames(symbol, candles, self.timeframe),
+        )
+        if signal:
+            self.on_signal(symbol, signal, price, position_side)
+
+def replay_stream(path, timeframe=base_timeframe):
+    # Прогон записанного потока без сети и без выставления ордеров
+    signals = []
+    stream = MarketStream([], timeframe, on_signal=lambda *signal: signals.append(signal))
+    with open(path) as f:
+        for line in f:
+            payload = json.loads(line)
+            data = payload.get('data', payload)
+            if isinstance(data, dict) and data.get('e') == 'kline':
+                name = data['s'].lower()
+                stream.symbols.setdefault(name, data['s'])
+            stream.handle_message(line)
+    for symbol, signal, price, position_side in signals:
+        print(f"{symbol} {signal} at price {price}. Position side: {position_side}")
+    return signals
+
+class UniverseScreener:
+    # Один запрос 24h тикера на все контракты раз в interval секунд вместо свечей и индикаторов по каждому
+    def __init__(self, top_n, min_quote_volume, min_volatility, max_volatility, interval):
+        self.top_n = top_n
+        self.min_quote_volume = min_quote_volume
+        self.min_volatility = min_volatility
+        self.max_volatility = max_volatility
+        self.interval = interval
+        self.selected = None
+        self.screened_at = 0
+
+    def select(self, client, usdt_pairs):
+        if self.selected is not None and time.time() - self.screened_at < self.interval:
+            return [pair for pair in usdt_pairs if pair in self.selected]
+        try:
+            tickers = {ticker['symbol']: ticker for ticker in client.futures_ticker()}
+        except Exception as e:
+            logging.error(f"Error fetching 24h tickers for screening: {e}")
+            return usdt_pairs if self.selected is None else [pair for pair in usdt_pairs if pair in self.selected]
+
+        ranked = []
+        for pair in usdt_pairs:
+            symbol = clean_symbol(pair)
+            info = symbol_metadata.get(client, symbol)
+            ticker = tickers.get(symbol)
+            # Делистинг, расчёт, поставочные контракты и пары без торгов отсекаются сразу
+            if info is None or ticker is None or info['status'] != 'TRADING' or info['contract_type'] != 'PERPETUAL':
+                continue
+            quote_volume = float(ticker['quoteVolume'])
+            last_price = float(ticker['lastPrice'])
+            if last_price <= 0:
+                continue
+            volatility = (float(ticker['highPrice']) - float(ticker['lowPrice'])) / last_price * 100
+            if quote_volume < self.min_quote_volume or volatility < self.min_volatility:
+                continue
+            if self.max_volatility and volatility > self.max_volatility:
+                continue
+            ranked.append((quote_volume, pair))
 
-        except (ConnectionError, HTTPError) as e:
-            send_telegram_message(f"Error creating order: {e}. Attempt {attempt + 1} of {max_retries}")
-            time.sleep(5)  # Pause before retrying
+        ranked.sort(reverse=True)
+        if self.top_n:
+            ranked = ranked[:self.top_n]
+        self.selected = {pair for _, pair in ranked}
+        self.screened_at = time.time()
+        logging.info(f"Screened universe: {len(self.selected)} of {len(usdt_pairs)} pairs selected")
+        return [pair for pair in usdt_pairs if pair in self.selected]
 
-    logging.error(f"Failed to create orders after {max_retries} attempts.")
+screener = UniverseScreener(screener_top_n, screener_min_quote_volume, screener_min_volatility, screener_max_volatility, screener_interval)
 
+def screen_universe(client, usdt_pairs):
+    if not screener_enabled:
+        return usdt_pairs
+    return screener.select(client, usdt_pairs)
 
-def main():
-    # Send Telegram message when bot starts
-    send_telegram_message("Bot started and ready for operation.")
+def seed_candles(symbols):
+    with ThreadPoolExecutor(max_workers=scan_concurrency, thread_name_prefix='seed') as pool:
+        list(pool.map(lambda symbol: fetch_candles(symbol, base_timeframe), symbols))
 
-    while True:
-        try:
-            # Clean up orders and ensure stop loss and take profit orders
-            cleanup_orders(binance_client)
-            ensure_stop_loss_take_profit(binance_client)
+def scan_symbol(symbol, closed_before=None):
+    try:
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        logging.info(f"Processing pair: {symbol} on {signal_timeframe} timeframe at {current_time}")
+
+        candles = fetch_candles(symbol, base_timeframe)
+        if candles is None:
+            return symbol, None, None, None
+
+        forming = closed_before is None
+        if not forming:
+            # Оцениваем только закрытые к этому моменту свечи
+            candles = candle_store.closed(symbol, base_timeframe, closed_before)
+        signal, price, position_side = evaluate_candles(
+            timeframe_candles(candles, base_timeframe, signal_timeframe, forming), symbol, signal_timeframe, forming,
+            confirmation_frames(symbol, candles, base_timeframe, forming),
+        )
+        return symbol, signal, price, position_side
+    except Exception as e:
+        logging.error(f"Error processing pair {symbol}: {e}")
+        return symbol, None, None, None
+
+def scan_markets(symbols, closed_before=None):
+    # Загрузка свечей и расчёт индикаторов идут параллельно, ордера выставляются последовательно
+    started = time.monotonic()
+    signals = []
+    with ThreadPoolExecutor(max_workers=scan_concurrency, thread_name_prefix='scan') as pool:
+        # В режиме профилирования скан идёт в основном потоке, чтобы его видел cProfile
+        mapper = map if profiling else pool.map
+        for symbol, signal, price, position_side in mapper(lambda symbol: scan_symbol(symbol, closed_before), symbols):
+            if signal:
+                signals.append((symbol, signal, price, position_side))
+    elapsed = time.monotonic() - started
+    metrics.observe('scan_seconds', elapsed)
+    metrics.set_gauge('scan_symbols', len(symbols))
+    logging.info(f"Scanned {len(symbols)} pairs in {elapsed:.2f}s, signals: {len(signals)}")
+    print(f"Scanned {len(symbols)} pairs in {elapsed:.2f}s, signals: {len(signals)}")
+    return signals
+
+def process_signal(symbol, signal, price, position_side, account=None):
+    account = account or get_account(binance_client)
+    client = account.client
+    settings = account.settings
+    try:
+        symbol = symbol.replace('/', '')
+        message = f"🟦🟦🟦[{account.name}] {symbol} {signal} at price {price}. Position side: {position_side}🟦🟦🟦"
+        logging.info(message)
+        print(message)
 
-            markets = exchange.load_markets()
-            usdt_pairs = [symbol for symbol in markets if symbol.endswith('USDT')]
+        step_size, tick_size, min_notional = get_symbol_info(client, symbol)
+        if step_size is None or min_notional is None:
+            return
 
-            for symbol in usdt_pairs:
-                try:
-                    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    logging.info(f"Processing pair: {symbol} on 15m timeframe at {current_time}")
-                    print(f"Processing pair: {symbol} on 15m timeframe at {current_time}")
+        set_margin_mode(client, symbol, settings['margin_mode'])
 
-                    df = fetch_ohlcv(symbol)
-                    if df is None:
-                        continue
+        balance = get_account_balance(client)
+        client.futures_change_leverage(symbol=symbol, leverage=settings['leverage'])
 
-                    df = calculate_indicators(df)
-                    if df is None:
-                        continue
+        current_price = get_current_price(client, symbol)
 
-                    signal, price, position_side = check_signals(df)
+        position_size = calculate_position_size(balance, settings['position_size_percent'], settings['leverage'], current_price, step_size, min_notional)
+        if position_size is None:
+            return
 
-                    if signal:
-                        symbol = symbol.replace('/', '')
-                        message = f"🟦🟦🟦{symbol} {signal} at price {price}. Position side: {position_side}🟦🟦🟦"
-                        logging.info(message)
-                        print(message)
+        take_profit_price, stop_loss_price = calculate_prices(current_price, settings['take_profit_percent'], settings['stop_loss_percent'], position_side, tick_size)
 
-                        step_size, tick_size, min_notional = get_symbol_info(binance_client, symbol)
-                        if step_size is None or min_notional is None:
-                            continue
+        position_mode = client.futures_get_position_mode()
+        if position_side == 'LONG':
+            position_side_setting = 'BOTH' if not position_mode['dualSidePosition'] else 'LONG'
+        elif position_side == 'SHORT':
+            position_side_setting = 'BOTH' if not position_mode['dualSidePosition'] else 'SHORT'
+        else:
+            logging.error(f"Invalid position_side in configuration: {position_side}")
+            return
 
-                        set_margin_mode(binance_client, symbol, margin_mode)
+        create_orders(client, symbol, position_size, take_profit_price, stop_loss_price, position_side_setting, position_side)
 
-                        balance = get_account_balance(binance_client)
-                        binance_client.futures_change_leverage(symbol=symbol, leverage=leverage)
+    except Exception as e:
+        logging.error(f"Error processing pair {symbol}: {e}")
+
+DEFAULT_STRATEGY_PARAMS = {
+    'bb_period': 14,
+    'bb_dev': 1.0,
+    'ema_period': 4,
+    'rsi_threshold': 50,
+    'take_profit_percent': take_profit_percent,
+    'stop_loss_percent': stop_loss_percent,
+    'breakeven_roi': BREAKEVEN_ROI,
+    'leverage': leverage,
+    'position_size_percent': position_size_percent,
+    'max_positions': MAX_POSITIONS_PER_SIDE,
+    'dedup_seconds': ORDER_DEDUP_SECONDS,
+    'fee_percent': 0.04,
+    'initial_balance': 1000.0,
+}
+
+def load_candles(path):
+    # Каталог с файлами <SYMBOL>.parquet или <SYMBOL>.csv и колонками OHLCV_COLUMNS
+    data = {}
+    for name in sorted(os.listdir(path)):
+        symbol, ext = os.path.splitext(name)
+        try:
+            if ext == '.parquet':
+                df = pd.read_parquet(os.path.join(path, name))
+            elif ext == '.csv':
+                df = pd.read_csv(os.path.join(path, name))
+            else:
+                continue
+            df = df[OHLCV_COLUMNS].sort_values('timestamp').reset_index(drop=True)
+            if not pd.api.types.is_numeric_dtype(df['timestamp']):
+                df['timestamp'] = pd.to_datetime(df['timestamp']).astype('datetime64[ms]').astype('int64')
+            data[symbol] = df
+        except Exception as e:
+            logging.error(f"Error loading candles for {symbol}: {e}")
+    return data
+
+def _simulate_exit(high, low, close, i, position_side, stop_loss_price, take_profit_price, breakeven_price, entry_price, chunk=1024):
+    # Ищем первую свечу после входа, на которой срабатывает TP, SL или безубыточный стоп.
+    # При касании TP и SL на одной свече считаем, что первым сработал стоп.
+    n = len(close)
+    long = position_side == 'LONG'
+    stop = stop_loss_price
+    breakeven = False
+    j = i + 1
+    while j < n:
+        k = min(j + chunk, n)
+        if long:
+            stop_hit = low[j:k] <= stop
+            take_hit = high[j:k] >= take_profit_price
+            trigger = close[j:k] >= breakeven_price
+        else:
+            stop_hit = high[j:k] >= stop
+            take_hit = low[j:k] <= take_profit_price
+            trigger = close[j:k] <= breakeven_price
+        first_stop = int(np.argmax(stop_hit)) if stop_hit.any() else k - j
+        first_take = int(np.argmax(take_hit)) if take_hit.any() else k - j
+        exit_at = min(first_stop, first_take)
+        if not breakeven and trigger.any():
+            first_trigger = int(np.argmax(trigger))
+            if first_trigger < exit_at:
+                # ROI выше порога на закрытии свечи: стоп переносится в точку входа со следующей свечи
+                breakeven = True
+                stop = max(stop, entry_price) if long else min(stop, entry_price)
+                j += first_trigger + 1
+                continue
+        if exit_at < k - j:
+            if first_stop <= first_take:
+                return j + exit_at, stop, 'breakeven' if breakeven else 'stop_loss'
+            return j + exit_at, take_profit_price, 'take_profit'
+        j = k
+    return n - 1, close[-1], 'open'
+
+def backtest_symbol(symbol, df, params):
+    frame = {column: np.asarray(df[column], dtype=np.float64) for column in OHLCV_COLUMNS}
+    values = calculate_indicators(frame, params['bb_period'], params['bb_dev'], params['ema_period'])
+    if values is None or len(frame['close']) < 2:
+        return []
+    previous = {column: values[column][:-1] for column in INDICATOR_COLUMNS}
+    latest = {column: values[column][1:] for column in INDICATOR_COLUMNS}
+    with np.errstate(invalid='ignore'):
+        buy_signal, sell_signal = signal_conditions(previous, latest, params['rsi_threshold'])
+
+    metadata = symbol_metadata.cached(symbol) or {}
+    tick_size = metadata.get('tick_size') or params.get('tick_size', 1e-8)
+    timestamps = frame['timestamp']
+    high, low, close = values['high'], values['low'], values['close']
+    breakeven_move = params['breakeven_roi'] / 100 / params['leverage']
+
+    trades = []
+    for i in np.flatnonzero(buy_signal | sell_signal) + 1:
+        position_side = 'LONG' if buy_signal[i - 1] else 'SHORT'
+        entry_price = close[i]
+        take_profit_price, stop_loss_price = calculate_prices(entry_price, params['take_profit_percent'], params['stop_loss_percent'], position_side, tick_size)
+        if take_profit_price is None:
+            continue
+        breakeven_price = entry_price * (1 + breakeven_move if position_side == 'LONG' else 1 - breakeven_move)
+        exit_index, exit_price, reason = _simulate_exit(high, low, close, i, position_side, stop_loss_price, take_profit_price, breakeven_price, entry_price)
+        trades.append({
+            'symbol': symbol,
+            'side': position_side,
+            'entry_time': int(timestamps[i]),
+            'entry_price': entry_price,
+            'take_profit': take_profit_price,
+            'stop_loss': stop_loss_price,
+            'exit_time': int(timestamps[exit_index]),
+            'exit_price': exit_price,
+            'reason': reason,
+        })
+    return trades
+
+def backtest(data, params=None):
+    params = {**DEFAULT_STRATEGY_PARAMS, **(params or {})}
+    candidates = []
+    for symbol, df in data.items():
+        candidates.extend(backtest_symbol(symbol, df, params))
+    candidates.sort(key=lambda trade: (trade['entry_time'], trade['symbol']))
+
+    # Портфельный прогон по времени: лимит позиций на сторону, окно повторного входа, реинвест баланса
+    balance = params['initial_balance']
+    pending = []  # куча (exit_time, pnl, side, symbol)
+    open_count = {'LONG': 0, 'SHORT': 0}
+    open_symbols = set()
+    last_entry = {}
+    trades = []
+    equity = [(0, balance)]
+
+    def settle(until):
+        nonlocal balance
+        while pending and pending[0][0] <= until:
+            exit_time, pnl, side, symbol = heapq.heappop(pending)
+            balance += pnl
+            open_count[side] -= 1
+            open_symbols.discard((symbol, side))
+            equity.append((exit_time, balance))
+
+    for trade in candidates:
+        settle(trade['entry_time'])
+        symbol, side = trade['symbol'], trade['side']
+        if trade['entry_time'] - last_entry.get(symbol, -np.inf) < params['dedup_seconds'] * 1000:
+            continue
+        if (symbol, side) in open_symbols or open_count[side] >= params['max_positions']:
+            continue
+        notional = balance * params['position_size_percent'] / 100 * params['leverage']
+        direction = 1 if side == 'LONG' else -1
+        gross = notional * direction * (trade['exit_price'] - trade['entry_price']) / trade['entry_price']
+        fees = notional * params['fee_percent'] / 100 * 2
+        trade = {**trade, 'notional': notional, 'pnl': gross - fees}
+        trades.append(trade)
+        last_entry[symbol] = trade['entry_time']
+        open_count[side] += 1
+        open_symbols.add((symbol, side))
+        heapq.heappush(pending, (trade['exit_time'], trade['pnl'], side, symbol))
+    settle(np.inf)
+
+    equity_curve = np.array([value for _, value in equity])
+    peaks = np.maximum.accumulate(equity_curve)
+    trades_df = pd.DataFrame(trades)
+    return {
+        'trades': trades_df,
+        'trade_count': len(trades),
+        'final_balance': balance,
+        'pnl': balance - params['initial_balance'],
+        'return_percent': (balance / params['initial_balance'] - 1) * 100,
+        'max_drawdown_percent': float(np.max((peaks - equity_curve) / peaks) * 100),
+        'win_rate': float((trades_df['pnl'] > 0).mean() * 100) if trades else 0.0,
+    }
+
+def print_backtest_report(report):
+    print(f"Trades: {report['trade_count']}")
+    print(f"PnL: {report['pnl']:.2f} USDT ({report['return_percent']:.2f}%)")
+    print(f"Final balance: {report['final_balance']:.2f} USDT")
+    print(f"Max drawdown: {report['max_drawdown_percent']:.2f}%")
+    print(f"Win rate: {report['win_rate']:.2f}%")
+    if report['trade_count']:
+        print(report['trades'].groupby('reason')['pnl'].agg(['count', 'sum']))
+
+def run_backtest(path, trades_path=None):
+    started = time.monotonic()
+    data = load_candles(path)
+    report = backtest(data)
+    print(f"Backtested {len(data)} symbols in {time.monotonic() - started:.2f}s")
+    print_backtest_report(report)
+    if trades_path:
+        report['trades'].to_csv(trades_path, index=False)
+    return report
+
+# Перебор параметров: значения через запятую в секции [Sweep] config.ini
+SWEEP_PARAMS = ['bb_period', 'bb_dev', 'ema_period', 'rsi_threshold', 'take_profit_percent', 'stop_loss_percent', 'breakeven_roi']
+
+def _parse_number(value):
+    value = value.strip()
+    return int(value) if value.lstrip('-').isdigit() else float(value)
+
+def sweep_grid():
+    grid = {}
+    for name in SWEEP_PARAMS:
+        values = config.get('Sweep', name, fallback='')
+        if values:
+            grid[name] = [_parse_number(value) for value in values.split(',')]
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def build_dataset(data, path):
+    # Все свечи в одном .npy формы (колонки, свечи): воркеры открывают его через mmap и не копируют
+    os.makedirs(path, exist_ok=True)
+    total = sum(len(df) for df in data.values())
+    candles = np.lib.format.open_memmap(os.path.join(path, 'candles.npy'), mode='w+', dtype=np.float64, shape=(len(OHLCV_COLUMNS), total))
+    index = []
+    start = 0
+    for symbol, df in data.items():
+        stop = start + len(df)
+        for i, column in enumerate(OHLCV_COLUMNS):
+            candles[i, start:stop] = df[column].to_numpy(dtype=np.float64)
+        index.append([symbol, start, stop])
+        start = stop
+    candles.flush()
+    del candles
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump({'symbols': index, 'signature': dataset_signature(data)}, f)
+
+def dataset_signature(data):
+    digest = hashlib.sha1()
+    for symbol, df in data.items():
+        digest.update(f"{symbol}:{len(df)}:{df['timestamp'].iloc[0]}:{df['timestamp'].iloc[-1]}:{df['close'].iloc[-1]}".encode())
+    return digest.hexdigest()
+
+def open_dataset(path):
+    candles = np.load(os.path.join(path, 'candles.npy'), mmap_mode='r')
+    with open(os.path.join(path, 'index.json')) as f:
+        index = json.load(f)
+    data = {}
+    for symbol, start, stop in index['symbols']:
+        data[symbol] = {column: candles[i, start:stop] for i, column in enumerate(OHLCV_COLUMNS)}
+    return data, index['signature']
+
+def slice_dataset(data, start_time=None, stop_time=None):
+    sliced = {}
+    for symbol, columns in data.items():
+        timestamps = columns['timestamp']
+        lo = 0 if start_time is None else int(np.searchsorted(timestamps, start_time, side='left'))
+        hi = len(timestamps) if stop_time is None else int(np.searchsorted(timestamps, stop_time, side='left'))
+        if hi - lo > 1:
+            sliced[symbol] = {column: values[lo:hi] for column, values in columns.items()}
+    return sliced
+
+_sweep_data = None
+
+def _init_sweep_worker(path):
+    global _sweep_data
+    _sweep_data, _ = open_dataset(path)
+
+def _run_sweep_task(params, start_time, stop_time):
+    report = backtest(slice_dataset(_sweep_data, start_time, stop_time), params)
+    return {key: float(report[key]) for key in ['trade_count', 'pnl', 'return_percent', 'max_drawdown_percent', 'win_rate']}
+
+def _sweep_key(params, start_time, stop_time, signature):
+    return hashlib.sha1(json.dumps([params, start_time, stop_time, signature], sort_keys=True).encode()).hexdigest()
+
+def run_sweep_tasks(tasks, dataset_path, signature, cache_path, workers):
+    # tasks: список (params, start_time, stop_time). Готовые результаты берутся из кэша,
+    # новые дописываются по мере завершения, поэтому прерванный перебор продолжается с места остановки.
+    results = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    results[record['key']] = record['result']
+                except ValueError:
+                    continue
+    keys = [_sweep_key(params, start_time, stop_time, signature) for params, start_time, stop_time in tasks]
+    missing = {key: task for key, task in zip(keys, tasks) if key not in results}
+    logging.info(f"Sweep: {len(tasks)} tasks, {len(tasks) - len(missing)} cached")
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker, initargs=(dataset_path,)) as pool, open(cache_path, 'a') as cache:
+            futures = {pool.submit(_run_sweep_task, *task): key for key, task in missing.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                key = futures[future]
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    logging.error(f"Sweep task failed: {e}")
+                    continue
+                cache.write(json.dumps({'key': key, 'params': missing[key][0], 'result': results[key]}) + '\n')
+                cache.flush()
+                if done % 10 == 0 or done == len(futures):
+                    print(f"Sweep progress: {done}/{len(futures)}")
+    return [results.get(key) for key in keys]
+
+def run_sweep(path, mode='grid'):
+    started = time.monotonic()
+    dataset_path = config.get('Sweep', 'dataset_path', fallback='sweep_dataset')
+    cache_path = config.get('Sweep', 'cache_path', fallback='sweep_results.jsonl')
+    workers = config.getint('Sweep', 'workers', fallback=os.cpu_count())
+    metric = config.get('Sweep', 'metric', fallback='return_percent')
+
+    data = load_candles(path)
+    signature = dataset_signature(data)
+    try:
+        _, cached_signature = open_dataset(dataset_path)
+    except Exception:
+        cached_signature = None
+    if cached_signature != signature:
+        build_dataset(data, dataset_path)
+    del data
+
+    combinations = sweep_grid()
+    if mode == 'random':
+        samples = config.getint('Sweep', 'samples', fallback=100)
+        rng = random.Random(config.getint('Sweep', 'seed', fallback=0))
+        combinations = rng.sample(combinations, min(samples, len(combinations)))
+
+    if mode == 'walk':
+        # Walk-forward: лучший набор на обучающем окне проверяется на следующем тестовом окне
+        train = config.getint('Sweep', 'train_days', fallback=90) * 86400000
+        test = config.getint('Sweep', 'test_days', fallback=30) * 86400000
+        dataset, _ = open_dataset(dataset_path)
+        first = min(int(columns['timestamp'][0]) for columns in dataset.values())
+        last = max(int(columns['timestamp'][-1]) for columns in dataset.values())
+        folds = []
+        start_time = first
+        while start_time + train < last:
+            folds.append((start_time, start_time + train, min(start_time + train + test, last + 1)))
+            start_time += test
+        train_tasks = [(params, fold[0], fold[1]) for fold in folds for params in combinations]
+        train_results = run_sweep_tasks(train_tasks, dataset_path, signature, cache_path, workers)
+        best = []
+        for i, fold in enumerate(folds):
+            scored = [(result[metric], params) for params, result in zip(combinations, train_results[i * len(combinations):(i + 1) * len(combinations)]) if result]
+            if scored:
+                best.append((max(scored, key=lambda item: item[0])[1], fold[1], fold[2]))
+        test_results = run_sweep_tasks(best, dataset_path, signature, cache_path, workers)
+        for (params, start_time, stop_time), result in zip(best, test_results):
+            period = f"{time.strftime('%Y-%m-%d', time.gmtime(start_time / 1000))} - {time.strftime('%Y-%m-%d', time.gmtime(stop_time / 1000))}"
+            print(f"{period}: {params} -> {result}")
+        print(f"Out-of-sample {metric}: {sum(result[metric] for result in test_results if result):.2f}")
+    else:
+        results = run_sweep_tasks([(params, None, None) for params in combinations], dataset_path, signature, cache_path, workers)
+        ranked = sorted((item for item in zip(combinations, results) if item[1]), key=lambda item: item[1][metric], reverse=True)
+        for params, result in ranked[:10]:
+            print(f"{params} -> {result}")
+
+    print(f"Sweep finished in {time.monotonic() - started:.2f}s")
+
+class MockRateLimitError(HTTPError):
+    pass
+
+class MockOrderNotFound(Exception):
+    code = ORDER_NOT_FOUND
+
+class MockNetwork:
+    # Общие для мок-клиентов задержка и лимит веса (weight_limit = 0 - без лимита)
+    def __init__(self, latency_ms=0, jitter_ms=0, weight_limit=0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.weight_limit = weight_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.spent = deque()
+        self.used = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def request(self, endpoint, weight=1):
+        # Бюджет веса резервируется так же, как в Transport для настоящих клиентов
+        if weight:
+            request_budget.acquire(weight)
+        with self.lock:
+            now = time.monotonic()
+            while self.spent and now - self.spent[0][0] >= 60:
+                self.used -= self.spent.popleft()[1]
+            self.requests += 1
+            if self.weight_limit and self.used + weight > self.weight_limit:
+                self.rejected += 1
+                metrics.inc('http_errors_total', client='mock', endpoint=endpoint)
+                raise MockRateLimitError(f"429 Too Many Requests: {endpoint}, used weight {self.used}")
+            self.spent.append((now, weight))
+            self.used += weight
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        if delay:
+            time.sleep(delay)
+        metrics.observe('http_request_seconds', delay, client='mock', endpoint=endpoint)
+        return {'X-MBX-USED-WEIGHT-1M': str(self.used)}
+
+def _synthetic_klines(count, timeframe_ms, seed, start_price=100.0):
+    rng = np.random.default_rng(seed)
+    close = start_price * np.exp(np.cumsum(rng.normal(0, 0.004, count)))
+    open_ = np.concatenate(([start_price], close[:-1]))
+    high = np.maximum(open_, close) * (1 + rng.uniform(0, 0.003, count))
+    low = np.minimum(open_, close) * (1 - rng.uniform(0, 0.003, count))
+    volume = rng.uniform(1, 100, count)
+    timestamps = np.arange(count, dtype=np.float64) * timeframe_ms
+    return np.column_stack((timestamps, open_, high, low, close, volume))
+
+def _replay_klines(template, count, timeframe_ms):
+    # Записанные свечи отдаются как есть (последние count). Если записи не хватает, она повторяется,
+    # а OHLC каждого повтора масштабируются одним множителем, чтобы open продолжал предыдущий close.
+    # Время переводится на общую для всех символов сетку, иначе now_ms() у фикстур и синтетики разойдутся.
+    segments = [template[-count:]]
+    filled = len(segments[0])
+    while filled < count:
+        segment = template[:count - filled].copy()
+        segment[:, 1:5] *= segments[-1][-1, 4] / segment[0, 1]
+        segments.append(segment)
+        filled += len(segment)
+    bars = np.concatenate(segments)
+    bars[:, 0] = np.arange(count, dtype=np.float64) * timeframe_ms
+    return bars
+
+class MockMarket:
+    # Свечи, exchangeInfo и аккаунт из записанных фикстур; недостающие символы генерируются
+    def __init__(self, symbols=50, fixtures_path=None, history=500, extra_bars=10, timeframe='15m', network=None):
+        self.timeframe_ms = parse_timeframe(timeframe) * 1000
+        self.network = network or MockNetwork()
+        self.klines = {}
+        self.exchange_info = {'symbols': []}
+        self.account = {'totalWalletBalance': '1000', 'positions': []}
+        self.open_orders = []
+        templates = {}
+        if fixtures_path:
+            self.exchange_info = self._load(fixtures_path, 'exchangeInfo.json', self.exchange_info)
+            self.account = self._load(fixtures_path, 'account.json', self.account)
+            self.open_orders = self._load(fixtures_path, 'openOrders.json', [])
+            klines_path = os.path.join(fixtures_path, 'klines')
+            if os.path.isdir(klines_path):
+                for name in sorted(os.listdir(klines_path)):
+                    templates[os.path.splitext(name)[0]] = np.array(self._load(klines_path, name, []), dtype=np.float64)
+
+        known = {info['symbol']: info for info in self.exchange_info['symbols']}
+        count = history + extra_bars
+        names = [name for name in templates if len(templates[name]) >= 2][:symbols]
+        for i in range(symbols):
+            name = names[i] if i < len(names) else f"MOCK{i}USDT"
+            template = templates.get(name)
+            if template is not None:
+                bars = _replay_klines(template, count, self.timeframe_ms)
+            else:
+                bars = _synthetic_klines(count, self.timeframe_ms, i)
+            self.klines[name] = bars
+            if name not in known:
+                known[name] = {
+                    'symbol': name, 'status': 'TRADING', 'contractType': 'PERPETUAL', 'quoteAsset': 'USDT',
+                    'filters': [
+                        {'filterType': 'PRICE_FILTER', 'tickSize': '0.0001'},
+                        {'filterType': 'LOT_SIZE', 'stepSize': '0.001'},
+                        {'filterType': 'MIN_NOTIONAL', 'notional': '5'},
+                    ],
+                }
+        self.exchange_info = {**self.exchange_info, 'symbols': [known[name] for name in self.klines]}
+        self.position = history
+
+    @staticmethod
+    def _load(path, name, default):
+        full_path = os.path.join(path, name)
+        if not os.path.exists(full_path):
+            return default
+        with open(full_path) as f:
+            return json.load(f)
+
+    def advance(self, bars=1):
+        self.position = min(self.position + bars, min(len(k) for k in self.klines.values()))
+
+    def now_ms(self):
+        # Текущее время - середина формирующейся свечи
+        return next(iter(self.klines.values()))[self.position - 1, 0] + self.timeframe_ms // 2
+
+    def last_price(self, symbol):
+        return float(self.klines[symbol][self.position - 1, 4])
+
+class MockExchange:
+    # Заменитель ccxt.binance для офлайн-прогонов
+    def __init__(self, market):
+        self.market = market
+        self.options = {}
+        self.last_response_headers = {}
+
+    parse_timeframe = staticmethod(parse_timeframe)
+
+    def milliseconds(self):
+        return int(self.market.now_ms())
+
+    def load_markets(self, reload=False):
+        self.last_response_headers = self.market.network.request('/fapi/v1/exchangeInfo', request_weight('/fapi/v1/exchangeInfo'))
+        return {f"{name[:-4]}/USDT:USDT": {'id': name, 'active': True} for name in self.market.klines}
+
+    def fetch_ohlcv(self, symbol, timeframe='15m', since=None, limit=None):
+        limit = 500 if limit is None else limit
+        self.last_response_headers = self.market.network.request('/fapi/v1/klines', request_weight('/fapi/v1/klines', {'limit': limit}))
+        bars = self.market.klines[clean_symbol(symbol)][:self.market.position]
+        if since is not None:
+            bars = bars[np.searchsorted(bars[:, 0], since):][:limit]
+        else:
+            bars = bars[-limit:]
+        return bars.tolist()
+
+class SimulatedAccount:
+    # Баланс, позиции и ордера в памяти с исполнением по _last_price: общая часть мок-клиента бенчмарка
+    # и paper-режима. Подклассы задают источник цен и рыночных данных.
+    def __init__(self, account, orders=(), dual_side=True):
+        self.response = None
+        self.order_id = 0
+        self.lock = threading.Lock()
+        self.account = account
+        self.dual_side = dual_side
+        self.orders = {order['orderId']: order for order in orders}
+        self.client_orders = {}
+        self.positions = {}
+        for pos in account.get('positions', []):
+            if float(pos['positionAmt']) != 0:
+                self.positions[(pos['symbol'], pos['positionSide'])] = pos
+
+    def _request(self, endpoint, params=None):
+        pass
+
+    def _last_price(self, symbol):
+        raise NotImplementedError
+
+    def futures_account(self):
+        self._request('/fapi/v2/account')
+        with self.lock:
+            return {**self.account, 'positions': list(self.positions.values())}
+
+    def futures_position_information(self, symbol=None):
+        self._request('/fapi/v2/positionRisk', {'symbol': symbol})
+        with self.lock:
+            return [pos for pos in self.positions.values() if symbol is None or pos['symbol'] == symbol]
+
+    def futures_get_open_orders(self, symbol=None):
+        self._request('/fapi/v1/openOrders', {'symbol': symbol})
+        with self.lock:
+            return [order for order in self.orders.values() if symbol is None or order['symbol'] == symbol]
+
+    def futures_get_position_mode(self):
+        self._request('/fapi/v1/positionSide/dual')
+        return {'dualSidePosition': self.dual_side}
+
+    def futures_change_leverage(self, symbol, leverage):
+        self._request('/fapi/v1/leverage')
+        return {'symbol': symbol, 'leverage': leverage}
+
+    def futures_change_margin_type(self, symbol, marginType):
+        self._request('/fapi/v1/marginType')
+        return {'code': 200, 'msg': 'success'}
+
+    def futures_get_order(self, symbol, origClientOrderId):
+        self._request('/fapi/v1/order')
+        with self.lock:
+            order = self.client_orders.get(origClientOrderId)
+        if order is None or order['symbol'] != symbol:
+            raise MockOrderNotFound(f"Order does not exist: {origClientOrderId}")
+        return order
+
+    def futures_cancel_order(self, symbol, orderId):
+        self._request('/fapi/v1/order')
+        with self.lock:
+            return self.orders.pop(orderId, {'symbol': symbol, 'orderId': orderId, 'status': 'CANCELED'})
+
+    def _fill(self, params):
+        with self.lock:
+            self.order_id += 1
+            order = {
+                'symbol': params['symbol'],
+                'orderId': self.order_id,
+                'type': params['type'],
+                'side': params['side'],
+                'positionSide': params.get('positionSide', 'BOTH'),
+                'origQty': str(params['quantity']),
+                'stopPrice': str(params.get('stopPrice', 0)),
+                'status': 'NEW',
+                'clientOrderId': params.get('newClientOrderId') or f"mock{self.order_id}",
+            }
+            self.client_orders[order['clientOrderId']] = order
+            if params['type'] == 'MARKET':
+                order['status'] = 'FILLED'
+                key = (params['symbol'], order['positionSide'])
+                amount = float(params['quantity']) * (1 if params['side'] == 'BUY' else -1)
+                pos = self.positions.get(key)
+                total = amount + (float(pos['positionAmt']) if pos else 0)
+                self.positions[key] = {
+                    'symbol': params['symbol'],
+                    'positionSide': order['positionSide'],
+                    'positionAmt': str(total),
+                    'entryPrice': str(self._last_price(params['symbol'])),
+                }
+            else:
+                self.orders[order['orderId']] = order
+            return order
+
+    def futures_create_order(self, **params):
+        self._request('/fapi/v1/order')
+        return self._fill(params)
+
+    def futures_place_batch_order(self, batchOrders):
+        self._request('/fapi/v1/batchOrders')
+        return [self._fill(params) for params in batchOrders]
+
+class MockBinanceClient(SimulatedAccount):
+    # Заменитель binance.client.Client: ордера исполняются мгновенно по последней цене
+    def __init__(self, market):
+        super().__init__(market.account, market.open_orders)
+        self.market = market
+
+    def _request(self, endpoint, params=None):
+        self.market.network.request(endpoint, request_weight(endpoint, params))
+
+    def _last_price(self, symbol):
+        return self.market.last_price(symbol)
+
+    def futures_time(self):
+        self._request('/fapi/v1/time')
+        return {'serverTime': int(time.time() * 1000)}
+
+    def futures_exchange_info(self):
+        self._request('/fapi/v1/exchangeInfo')
+        return self.market.exchange_info
+
+    def futures_ticker(self, **params):
+        self._request('/fapi/v1/ticker/24hr', params)
+        tickers = []
+        for name, bars in self.market.klines.items():
+            day = bars[max(0, self.market.position - 96):self.market.position]
+            tickers.append({
+                'symbol': name,
+                'lastPrice': str(day[-1, 4]),
+                'highPrice': str(day[:, 2].max()),
+                'lowPrice': str(day[:, 3].min()),
+                'quoteVolume': str(float((day[:, 4] * day[:, 5]).sum())),
+            })
+        return tickers
+
+    def get_symbol_ticker(self, symbol):
+        self._request('/api/v3/ticker/price', {'symbol': symbol})
+        return {'symbol': symbol, 'price': str(self._last_price(symbol))}
+
+class PaperClient(SimulatedAccount):
+    # Paper-режим: публичные данные с биржи через неподписанный клиент, баланс, позиции и ордера - в памяти.
+    # TP/SL исполняются по mark/последней цене при каждом чтении аккаунта (settle), PnL идёт в баланс.
+    # Режим позиций (hedge/one-way) берётся с настоящего аккаунта, если заданы ключи, иначе из конфига.
+    def __init__(self, public, balance, signed=None, dual_side=True):
+        super().__init__({'totalWalletBalance': str(balance)}, dual_side=dual_side)
+        self.public = public
+        self.signed = signed
+        self.position_mode = None
+
+    def futures_get_position_mode(self):
+        if self.signed is None:
+            return super().futures_get_position_mode()
+        # Только чтение, и режим аккаунта меняется редко: запрашиваем один раз
+        if self.position_mode is None:
+            self.position_mode = self.signed.futures_get_position_mode()
+        return self.position_mode
+
+    def _last_price(self, symbol):
+        mark = mark_prices.get(symbol)
+        if mark is not None and time.time() - mark[1] < 5:
+            return mark[0]
+        return float(self.public.futures_symbol_ticker(symbol=symbol)['price'])
+
+    @staticmethod
+    def _triggered(order, price):
+        # Закрытие лонга (SELL): TP выше цены входа, SL ниже; для шорта наоборот
+        stop_price = float(order['stopPrice'])
+        above = price >= stop_price
+        below = price <= stop_price
+        if order['type'] == 'TAKE_PROFIT_MARKET':
+            return above if order['side'] == 'SELL' else below
+        return below if order['side'] == 'SELL' else above
+
+    def settle(self):
+        with self.lock:
+            symbols = {order['symbol'] for order in self.orders.values()}
+        # Цены запрашиваются вне блокировки: _fill держит её во время _last_price
+        prices = {symbol: self._last_price(symbol) for symbol in symbols}
+        with self.lock:
+            for order in sorted(self.orders.values(), key=lambda order: order['orderId']):
+                if order['orderId'] not in self.orders or not self._triggered(order, prices[order['symbol']]):
+                    continue
+                del self.orders[order['orderId']]
+                key = (order['symbol'], order['positionSide'])
+                pos = self.positions.get(key)
+                if pos is None:
+                    continue
+                price = prices[order['symbol']]
+                amount = float(pos['positionAmt'])
+                quantity = min(float(order['origQty']), abs(amount))
+                direction = 1 if amount > 0 else -1
+                pnl = (price - float(pos['entryPrice'])) * quantity * direction
+                self.account['totalWalletBalance'] = str(float(self.account['totalWalletBalance']) + pnl)
+                remaining = amount - quantity * direction
+                logging.info(f"Paper {order['type']} filled for {order['symbol']} at {price}, PnL {pnl:.4f} USDT")
+                if abs(remaining) < 1e-12:
+                    # Позиция закрыта: оставшиеся TP/SL по ней больше ничего не защищают
+                    del self.positions[key]
+                    for other in [o for o in self.orders.values() if (o['symbol'], o['positionSide']) == key]:
+                        del self.orders[other['orderId']]
+                else:
+                    pos['positionAmt'] = str(remaining)
+
+    def futures_account(self):
+        self.settle()
+        return super().futures_account()
+
+    def futures_position_information(self, symbol=None):
+        self.settle()
+        return super().futures_position_information(symbol)
+
+    def futures_get_open_orders(self, symbol=None):
+        self.settle()
+        return super().futures_get_open_orders(symbol)
+
+    def futures_time(self):
+        return self.public.futures_time()
+
+    def futures_exchange_info(self):
+        return self.public.futures_exchange_info()
+
+    def futures_ticker(self, **params):
+        return self.public.futures_ticker(**params)
+
+    def get_symbol_ticker(self, symbol):
+        return self.public.get_symbol_ticker(symbol=symbol)
+
+def record_fixtures(path, symbols=50):
+    # Запись фикстур с живой биржи для офлайн-бенчмарков
+    os.makedirs(os.path.join(path, 'klines'), exist_ok=True)
+    with open(os.path.join(path, 'exchangeInfo.json'), 'w') as f:
+        json.dump(binance_client.futures_exchange_info(), f)
+    with open(os.path.join(path, 'account.json'), 'w') as f:
+        json.dump(binance_client.futures_account(), f)
+    with open(os.path.join(path, 'openOrders.json'), 'w') as f:
+        json.dump(binance_client.futures_get_open_orders(), f)
+    markets = exchange.load_markets()
+    usdt_pairs = [symbol for symbol in markets if symbol.endswith('USDT')][:symbols]
+    for symbol in usdt_pairs:
+        with open(os.path.join(path, 'klines', clean_symbol(symbol) + '.json'), 'w') as f:
+            json.dump(exchange.fetch_ohlcv(symbol, timeframe='15m', limit=candle_history), f)
+    print(f"Recorded fixtures for {len(usdt_pairs)} symbols to {path}")
+
+def install_mocks(market):
+    # Подменяем глобальные клиенты и кэши модуля на мок-версии; возвращаем прежние для восстановления
+    global exchange, binance_client, market_client, candle_store, streaming_indicators, symbol_metadata, request_budget, notifier, screener, state_store, trading_accounts
+    saved = (exchange, binance_client, market_client, candle_store, streaming_indicators, symbol_metadata, request_budget, notifier, screener, state_store, trading_accounts, dict(open_orders))
+    exchange = MockExchange(market)
+    binance_client = MockBinanceClient(market)
+    market_client = binance_client
+    candle_store = CandleStore(candle_history)
+    streaming_indicators = StreamingIndicators()
+    symbol_metadata = SymbolMetadata(exchange_info_ttl, '')
+    request_budget = WeightBudget(market.network.weight_limit or 10 ** 9)
+    notifier = NotificationQueue(lambda text: None)
+    screener = UniverseScreener(screener_top_n, screener_min_quote_volume, screener_min_volatility, screener_max_volatility, screener_interval)
+    state_store = StateStore('')
+    open_orders.clear()
+    trading_accounts = [get_account(binance_client)]
+    mark_prices.clear()
+    return saved
+
+def restore_mocks(saved):
+    global exchange, binance_client, market_client, candle_store, streaming_indicators, symbol_metadata, request_budget, notifier, screener, state_store, trading_accounts
+    exchange, binance_client, market_client, candle_store, streaming_indicators, symbol_metadata, request_budget, notifier, screener, state_store, trading_accounts, orders = saved
+    open_orders.clear()
+    open_orders.update(orders)
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return ''
 
-                        ticker = binance_client.get_symbol_ticker(symbol=symbol)
-                        current_price = float(ticker['price'])
+def _benchmark_size(size, fixtures_path, latency_ms, weight_limit, cycles):
+    market = MockMarket(size, fixtures_path, history=candle_history, extra_bars=cycles + 1, network=MockNetwork(latency_ms, latency_ms / 4, weight_limit))
+    saved = install_mocks(market)
+    try:
+        result = {}
+        started = time.perf_counter()
+        run_cycle()
+        result['cold_cycle_s'] = time.perf_counter() - started
+
+        durations = []
+        for _ in range(cycles):
+            market.advance()
+            started = time.perf_counter()
+            run_cycle()
+            durations.append(time.perf_counter() - started)
+        result['warm_cycle_s'] = float(np.median(durations))
+        result['per_symbol_ms'] = result['warm_cycle_s'] / size * 1000
+
+        # Пропускная способность индикаторов: полный пересчёт TA-Lib и пакетный инкрементальный движок
+        columns = [candle_store.buffers[key].columns() for key in list(candle_store.buffers)]
+        bars = sum(len(c['close']) for c in columns)
+        started = time.perf_counter()
+        for c in columns:
+            calculate_indicators(dict(c))
+        result['talib_bars_per_s'] = bars / (time.perf_counter() - started)
+        length = min(len(c['close']) for c in columns)
+        stacked = {column: np.vstack([c[column][-length:] for c in columns]) for column in ['high', 'low', 'close', 'volume']}
+        started = time.perf_counter()
+        batch_indicators(stacked['high'], stacked['low'], stacked['close'], stacked['volume'])
+        result['streaming_bars_per_s'] = len(columns) * length / (time.perf_counter() - started)
+
+        # Задержка выставления ордеров (вход + TP + SL)
+        latencies = []
+        for name in list(market.klines)[:5]:
+            open_orders.clear()
+            get_account_snapshot(binance_client).invalidate()
+            price = market.last_price(name)
+            started = time.perf_counter()
+            create_orders(binance_client, name, 0.01, round(price * 1.03, 4), round(price * 0.985, 4), 'LONG', 'LONG')
+            latencies.append(time.perf_counter() - started)
+        result['order_placement_ms'] = float(np.median(latencies)) * 1000
+        result['requests'] = market.network.requests
+        result['rate_limited'] = market.network.rejected
+        return result
+    finally:
+        restore_mocks(saved)
+
+def run_benchmarks(sizes=(50, 300, 1000), fixtures_path=None, output='benchmarks.jsonl', latency_ms=20, weight_limit=0, cycles=3):
+    previous = {}
+    if os.path.exists(output):
+        with open(output) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    previous[record['size']] = record
+                except ValueError:
+                    continue
 
-                        position_size = calculate_position_size(balance, position_size_percent, leverage, current_price, step_size, min_notional)
-                        if position_size is None:
-                            continue
+    revision = _git_revision()
+    for size in sizes:
+        result = _benchmark_size(size, fixtures_path, latency_ms, weight_limit, cycles)
+        record = {'time': datetime.now().isoformat(timespec='seconds'), 'revision': revision, 'size': size, 'latency_ms': latency_ms, **result}
+        with open(output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        print(f"--- {size} symbols ---")
+        baseline = previous.get(size)
+        for key, value in result.items():
+            line = f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}"
+            if baseline and isinstance(value, float) and baseline.get(key):
+                change = (value - baseline[key]) / baseline[key] * 100
+                # Для пропускной способности хуже - меньше, для времени - больше
+                worse = change < -10 if key.endswith('_per_s') else change > 10
+                line += f" ({change:+.1f}% vs {baseline['revision'] or 'previous'}{', REGRESSION' if worse else ''})"
+            print(line)
+
+def run_validation(fixtures_path=None, symbols=20, tolerance=1e-6):
+    # Инкрементальный движок против TA-Lib свеча за свечой на фикстурах (или синтетике без них)
+    market = MockMarket(symbols, fixtures_path, history=max(candle_history, 1000), extra_bars=0)
+    failed = []
+    for name, bars in market.klines.items():
+        df = pd.DataFrame(bars[:, 2:6], columns=['high', 'low', 'close', 'volume'])
+        errors = validate_indicators(df, tolerance)
+        worst = max(errors, key=errors.get)
+        print(f"{name}: {len(df)} bars, max relative error {errors[worst]:.3g} ({worst})")
+        if errors[worst] > tolerance:
+            failed.append(name)
+    if failed:
+        print(f"Validation FAILED for {len(failed)} of {len(market.klines)} symbols (tolerance {tolerance}): {', '.join(failed)}")
+    else:
+        print(f"Validation passed for {len(market.klines)} symbols (tolerance {tolerance})")
+    return not failed
+
+def refresh_account(client):
+    snapshot = get_account_snapshot(client)
+    if not snapshot.live:
+        try:
+            snapshot.refresh()
+        except Exception as e:
+            logging.error(f"Error refreshing account snapshot: {e}")
 
-                        take_profit_price, stop_loss_price = calculate_prices(current_price, take_profit_percent, stop_loss_percent, position_side, tick_size)
+def reconcile_state(client):
+    # Сверка сохранённого состояния с биржей при старте: один снимок аккаунта вместо полного пересканирования
+    account = get_account(client)
+    state_store, open_orders = account.state_store, account.open_orders
+    snapshot = get_account_snapshot(client)
+    try:
+        snapshot.refresh()
+    except Exception as e:
+        logging.error(f"Error reconciling state: {e}")
+        return
+    resolved = 0
+    for intent in state_store.pending_intents():
+        # Процесс упал между отправкой входа и записью результата: позиция на бирже - значит вход был.
+        # Снимок ключуется positionSide биржи ('BOTH' в one-way режиме), его берём из параметров входа
+        position_side = json.loads(intent['params'])['entry']['positionSide']
+        if (intent['symbol'], position_side) in snapshot.positions:
+            state_store.update_intent(intent['id'], 'placed')
+            state_store.record_entry(intent['symbol'], intent['created_at'])
+        else:
+            state_store.update_intent(intent['id'], 'failed')
+        resolved += 1
+
+    live_orders = {order['orderId']: order for order in snapshot.open_orders()}
+    closed = 0
+    for order in state_store.open_orders():
+        if order['order_id'] not in live_orders:
+            state_store.update_order_status(order['order_id'], 'CLOSED')
+            closed += 1
+    for order in live_orders.values():
+        state_store.record_order(order)
+
+    state_store.prune_entries(ORDER_DEDUP_SECONDS)
+    open_orders.clear()
+    open_orders.update({symbol: datetime.fromtimestamp(placed_at) for symbol, placed_at in state_store.entry_times().items()})
+    logging.info(
+        f"State reconciled for {account.name}: {len(snapshot.positions)} positions, {len(live_orders)} open orders, "
+        f"{resolved} pending intents resolved, {closed} stale orders closed, {len(open_orders)} recent entries"
+    )
+
+def run_cycle():
+    started = time.monotonic()
+    try:
+        for account in trading_accounts:
+            with account.lock:
+                refresh_account(account.client)
+                # Clean up orders and ensure stop loss and take profit orders
+                cleanup_orders(account.client)
+                ensure_stop_loss_take_profit(account.client)
+
+        markets = exchange.load_markets()
+        usdt_pairs = [symbol for symbol in markets if symbol.endswith('USDT')]
+        usdt_pairs = screen_universe(market_client, usdt_pairs)
+
+        futures = []
+        for symbol, signal, price, position_side in scan_markets(usdt_pairs):
+            futures.extend(dispatch_signal(symbol, signal, price, position_side))
+        for future in futures:
+            future.result()
 
-                        position_mode = binance_client.futures_get_position_mode()
-                        if position_side == 'LONG':
-                            position_side_setting = 'BOTH' if not position_mode['dualSidePosition'] else 'LONG'
-                        elif position_side == 'SHORT':
-                            position_side_setting = 'BOTH' if not position_mode['dualSidePosition'] else 'SHORT'
-                        else:
-                            logging.error(f"Invalid position_side in configuration: {position_side}")
-                            continue
+    except Exception as e:
+        logging.error(f"Error loading markets: {e}")
+    metrics.observe('cycle_seconds', time.monotonic() - started)
 
-                        create_orders(binance_client, symbol, position_size, take_profit_price, stop_loss_price, position_side_setting, position_side)
 
-                except Exception as e:
-                    logging.error(f"Error processing pair {symbol}: {e}")
+class ExchangeClock:
+    # Время биржи = локальное время + смещение, измеренное по futures_time() с поправкой на половину RTT
+    def __init__(self, client):
+        self.client = client
+        self.offset_ms = 0
 
+    def sync(self):
+        try:
+            sent = time.time()
+            server_time = self.client.futures_time()['serverTime']
+            received = time.time()
+            self.offset_ms = server_time - (sent + received) / 2 * 1000
+            logging.info(f"Exchange clock offset: {self.offset_ms:.0f}ms, round trip: {(received - sent) * 1000:.0f}ms")
         except Exception as e:
-            logging.error(f"Error loading markets: {e}")
+            logging.error(f"Error syncing exchange clock: {e}")
+
+    def now_ms(self):
+        return time.time() * 1000 + self.offset_ms
+
+class ScheduledTask:
+    def __init__(self, name, func, interval, offset=0, aligned=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.offset = offset
+        self.aligned = aligned
+        self.last_start = None
+        self.last_duration = None
+        self.overruns = 0
+
+    def next_run(self, now_ms):
+        interval_ms = self.interval * 1000
+        if self.aligned:
+            # Ближайшая граница интервала по времени биржи плюс задержка offset
+            offset_ms = self.offset * 1000
+            return ((now_ms - offset_ms) // interval_ms + 1) * interval_ms + offset_ms
+        if self.last_start is None:
+            return now_ms
+        return self.last_start + interval_ms
+
+class Scheduler:
+    # У каждой задачи свой поток и таймер: долгий скан не задерживает обслуживание стопов
+    def __init__(self, clock):
+        self.clock = clock
+        self.tasks = []
+        self.stopped = threading.Event()
+
+    def add(self, name, func, interval, offset=0, aligned=True):
+        self.tasks.append(ScheduledTask(name, func, interval, offset, aligned))
+
+    def start(self):
+        for task in self.tasks:
+            threading.Thread(target=self._run, args=(task,), name=f"task-{task.name}", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run_forever(self):
+        self.start()
+        while not self.stopped.wait(1):
+            pass
+
+    def _run(self, task):
+        while not self.stopped.is_set():
+            scheduled = task.next_run(self.clock.now_ms())
+            if self.stopped.wait(max(0, (scheduled - self.clock.now_ms()) / 1000)):
+                break
+            task.last_start = self.clock.now_ms()
+            lateness = task.last_start - scheduled
+            if lateness > task.interval * 1000:
+                logging.warning(f"Task {task.name} started {lateness / 1000:.1f}s late")
+            started = time.monotonic()
+            try:
+                task.func()
+            except Exception as e:
+                logging.error(f"Error in scheduled task {task.name}: {e}")
+            task.last_duration = time.monotonic() - started
+            metrics.observe('task_seconds', task.last_duration, task=task.name)
+            if task.last_duration > task.interval:
+                # Пропущенные запуски не догоняем: следующий будет на ближайшей границе
+                task.overruns += 1
+                metrics.inc('task_overruns_total', task=task.name)
+                logging.warning(f"Task {task.name} overran: {task.last_duration:.1f}s > {task.interval}s interval ({task.overruns} overruns)")
+
+def run_protection_maintenance():
+    # Ордера меняют и скан сигналов, и обслуживание стопов, поэтому под блокировкой аккаунта
+    for account in trading_accounts:
+        with account.lock:
+            refresh_account(account.client)
+            cleanup_orders(account.client)
+            # При живом user-data потоке позиции защищаются по событиям и mark price,
+            # полная сверка (с REST-тикером на каждую позицию) - только раз в reconcile_interval
+            protection = get_protection_manager(account.client)
+            if protection.snapshot.live and time.monotonic() - protection.reconciled_at < scheduler_reconcile_interval:
+                continue
+            ensure_stop_loss_take_profit(account.client)
+
+def run_signal_scan(clock):
+    markets = exchange.load_markets()
+    usdt_pairs = [symbol for symbol in markets if symbol.endswith('USDT')]
+    usdt_pairs = screen_universe(market_client, usdt_pairs)
+
+    for symbol, signal, price, position_side in scan_markets(usdt_pairs, closed_before=clock.now_ms()):
+        dispatch_signal(symbol, signal, price, position_side)
+
+def on_mark_price(symbol, price):
+    for account in trading_accounts:
+        get_protection_manager(account.client).on_mark_price(symbol, price)
+
+def run_scheduled():
+    if user_stream_enabled and trading_mode == 'live':
+        # Без потока свечей: только mark price, чтобы перевод стопа в безубыток не ждал сверки
+        MarketStream([], base_timeframe, on_mark_price=on_mark_price).start()
+    clock = ExchangeClock(market_client)
+    clock.sync()
+    scheduler = Scheduler(clock)
+    scheduler.add('signals', lambda: run_signal_scan(clock), parse_timeframe(signal_timeframe), offset=scheduler_scan_delay)
+    scheduler.add('protection', run_protection_maintenance, scheduler_maintenance_interval, aligned=False)
+    scheduler.add('clock', clock.sync, scheduler_clock_sync_interval, aligned=False)
+    scheduler.run_forever()
+
+def run_streaming():
+    markets = exchange.load_markets()
+    usdt_pairs = [symbol for symbol in markets if symbol.endswith('USDT')]
+
+    # Подписываемся на все пары (WebSocket не тратит вес), а свечи и сигналы ведём только для отобранных
+    stream = MarketStream(usdt_pairs, base_timeframe, record_path=stream_record_path, on_mark_price=on_mark_price)
+    stream.active = set()
+    stream.start()
+
+    def update_universe():
+        active = set(screen_universe(market_client, usdt_pairs))
+        seed_candles(active - stream.active)
+        stream.active = active
+
+    clock = ExchangeClock(market_client)
+    scheduler = Scheduler(clock)
+    scheduler.add('universe', update_universe, screener_interval, aligned=False)
+    scheduler.add('protection', run_protection_maintenance, scheduler_maintenance_interval, aligned=False)
+    scheduler.start()
+
+    while True:
+        symbol, signal, price, position_side = signal_queue.get()
+        dispatch_signal(symbol, signal, price, position_side)
+
+def run_profile(path, cycles):
+    global profiling
+    profiling = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        for _ in range(cycles):
+            run_cycle()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(metrics.summary())
+        print(f"Profile saved to {path}")
+
+def main():
+    # Send Telegram message when bot starts
+    send_telegram_message("Bot started and ready for operation." if trading_mode == 'live' else "Bot started in paper trading mode.")
+
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    if metrics_summary_interval:
+        start_metrics_reporter(metrics_summary_interval)
+
+    for account in trading_accounts:
+        reconcile_state(account.client)
+        # В paper-режиме нет listenKey: позиции симулируются локально
+        if user_stream_enabled and trading_mode == 'live':
+            protection = get_protection_manager(account.client)
+            UserDataStream(account.client, listeners=[account.state_store.on_user_event, protection.on_user_event]).start()
 
+    if stream_enabled:
+        run_streaming()
+        return
+
+    if scheduler_enabled:
+        run_scheduled()
+        return
+
+    while True:
+        run_cycle()
         time.sleep(30)  # Pause for 30 seconds before re-checking
 
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', metavar='FILE', help='replay a recorded stream offline')
+    parser.add_argument('--backtest', metavar='DIR', help='backtest on local Parquet/CSV candles')
+    parser.add_argument('--trades', metavar='FILE', help='write backtest trades to CSV')
+    parser.add_argument('--sweep', metavar='DIR', help='run a parameter sweep over local candles')
+    parser.add_argument('--mode', choices=['grid', 'random', 'walk'], default='grid', help='sweep mode')
+    parser.add_argument('--profile', metavar='FILE', help='run --cycles scan cycles under cProfile and save stats')
+    parser.add_argument('--cycles', type=int, default=1, help='number of cycles to profile')
+    parser.add_argument('--bench', action='store_true', help='run offline benchmarks against the mock exchange')
+    parser.add_argument('--validate', action='store_true', help='check streaming indicators against TA-Lib on --fixtures data')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='max relative error allowed by --validate')
+    parser.add_argument('--fixtures', metavar='DIR', help='recorded fixtures for the mock exchange')
+    parser.add_argument('--sizes', default='50,300,1000', help='comma-separated universe sizes to benchmark')
+    parser.add_argument('--latency-ms', type=float, default=20, help='simulated request latency')
+    parser.add_argument('--weight-limit', type=int, default=0, help='simulated IP weight limit per minute (0 - unlimited)')
+    parser.add_argument('--bench-output', default='benchmarks.jsonl', help='benchmark results history')
+    parser.add_argument('--record-fixtures', metavar='DIR', help='record fixtures from the live exchange')
+    parser.add_argument('--paper', action='store_true', help='trade on live market data with simulated orders')
+    args = parser.parse_args()
+    if args.paper:
+        # Клиенты создаются лениво, поэтому режим можно переключить до первого запроса
+        trading_mode = 'paper'
+    if args.bench:
+        run_benchmarks([int(size) for size in args.sizes.split(',')], args.fixtures, args.bench_output, args.latency_ms, args.weight_limit)
+    elif args.validate:
+        sys.exit(0 if run_validation(args.fixtures, tolerance=args.tolerance) else 1)
+    elif args.record_fixtures:
+        record_fixtures(args.record_fixtures)
+    elif args.profile:
+        run_profile(args.profile, args.cycles)
+    elif args.replay:
+        replay_stream(args.replay)
+    elif args.backtest:
+        run_backtest(args.backtest, args.trades)
+    elif args.sweep:
+        run_sweep(args.sweep, args.mode)
+    else:
+        main()